@@ -8,7 +8,9 @@ use myblog;
 
 grant select, insert, update, delete on myblog.* to 'www-data'@'localhost' identified by 'www-data';
 
-create table users (
+-- 以下由python www/dbtool.py ddl根据models.py生成
+
+create table `users` (
     `id` varchar(50) not null,
     `email` varchar(50) not null,
     `password` varchar(50) not null,
@@ -21,7 +23,7 @@ create table users (
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table blogs (
+create table `blogs` (
     `id` varchar(50) not null,
     `user_id` varchar(50) not null,
     `user_name` varchar(50) not null,
@@ -31,10 +33,11 @@ create table blogs (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_user_id` (`user_id`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table comments (
+create table `comments` (
     `id` varchar(50) not null,
     `blog_id` varchar(50) not null,
     `user_id` varchar(50) not null,
@@ -43,5 +46,23 @@ create table comments (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`,`created_at`),
+    key `idx_user_id` (`user_id`),
+    primary key (`id`)
+) engine=innodb default charset=utf8;
+
+create table `jobs` (
+    `id` varchar(100) not null,
+    `name` varchar(100) not null,
+    `args` mediumtext not null,
+    `status` varchar(20) not null,
+    `attempts` bigint not null,
+    `max_attempts` bigint not null,
+    `run_at` real not null,
+    `locked_by` varchar(50) not null,
+    `locked_at` real not null,
+    `last_error` mediumtext not null,
+    `created_at` real not null,
+    key `idx_status_run_at` (`status`,`run_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
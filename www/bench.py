@@ -0,0 +1,365 @@
+# bench.py
+# -*- encoding: utf-8 -*-
+
+"""
+性能基准测试，使用sqlite3代替MySQL，不需要数据库服务
+    python bench.py --users 100 --blogs 1000 --comments 5000 --out result.json
+    python bench.py --baseline result.json     # 与之前的结果比较，变慢超过tolerance时返回1
+    python bench.py --no-prepared              # 不使用prepared statement，比较parses/op
+    python bench.py --concurrency 50 --db-latency 5 --threads 8
+                                               # 50个并发请求由8个线程处理，每条sql经socket等待5ms，模拟网络上的数据库
+    WORKER_CLASS=gevent python bench.py --concurrency 50 --db-latency 5
+                                               # 同上，每个请求一个gevent协程，与gevent worker相同
+等待由另一个进程中的延迟服务器完成，是真实的socket往返，而不是进程内的time.sleep；
+用C扩展驱动（如MySQLdb）时gevent无法切换协程，这里的结果只代表纯python驱动
+"""
+
+import os
+# 与wsgiapp.py相同，gevent模式需要在导入其他模块之前打补丁，之后创建的线程都是协程
+WORKER_CLASS = os.environ.get('WORKER_CLASS', 'sync')
+if WORKER_CLASS == 'gevent':
+    from gevent import monkey; monkey.patch_all()
+
+import sys
+import json
+import time
+import random
+import timeit
+import logging
+import argparse
+import tempfile
+import sqlite3
+import socket
+import signal
+import threading
+import Queue
+import SocketServer
+import platform
+
+from transwarp import db
+from transwarp.web import WSGIApplication, get
+from models import User, Blog, Comment
+
+_TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+@get('/bench')
+def bench_index():
+    return 'ok'
+
+@get('/bench/users/:user_id')
+def bench_user(user_id):
+    return User.get(user_id).name
+
+@get('/bench/blogs/:blog_id/comments')
+def bench_comments(blog_id):
+    return '%d' % len(Comment.find_by('where blog_id=?', blog_id))
+
+class _CountingDriver(object):
+    """
+    sqlite3的替身驱动，统计sql被解析的次数
+    普通cursor每次execute都解析一次，相当于MySQL的文本协议；
+    cursor(prepared=True)只在sql改变时解析，相当于服务端prepared statement
+    latency不为0时每次execute先向address的延迟服务器发一个请求，等待latency秒后的应答，模拟网络上的数据库
+    """
+    paramstyle = 'qmark'
+
+    def __init__(self):
+        self.__name__ = 'counting_sqlite3'
+        self.parses = 0
+        self.latency = 0
+        self.address = None
+
+    def connect(self, **kw):
+        return _CountingConnection(self, sqlite3.connect(**kw))
+
+class _CountingConnection(object):
+    def __init__(self, driver, conn):
+        self._driver = driver
+        self._conn = conn
+        self._sock = None
+
+    def cursor(self, prepared=False):
+        return _CountingCursor(self._driver, self._conn.cursor(), prepared, self)
+
+    def wait(self, latency):
+        # 每个连接一个socket，与真实驱动一样在连接上阻塞等待应答
+        if self._sock is None:
+            self._sock = socket.create_connection(self._driver.address)
+            self._file = self._sock.makefile('rb')
+        self._sock.sendall('%f\n' % latency)
+        self._file.readline()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class _CountingCursor(object):
+    def __init__(self, driver, cursor, prepared, conn):
+        self._driver = driver
+        self._cursor = cursor
+        self._prepared = prepared
+        self._conn = conn
+        self._sql = None
+
+    def _parse(self, sql, times=1):
+        if not self._prepared:
+            self._driver.parses += times
+        elif sql != self._sql:
+            self._driver.parses += 1
+            self._sql = sql
+
+    def execute(self, sql, args=()):
+        self._parse(sql)
+        if self._driver.latency:
+            self._conn.wait(self._driver.latency)
+        return self._cursor.execute(sql, args)
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        self._parse(sql, len(rows))
+        return self._cursor.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+def _create_tables():
+    for model in (User, Blog, Comment):
+        cols = ['%s %s%s' % (f.name, f.ddl, ' primary key' if f.primary_key else '') for f in model.__mappings__.itervalues()]
+        db.update('create table %s (%s)' % (model.__table__, ', '.join(cols)))
+    db.update('create index idx_blogs_user_id on blogs (user_id)')
+    db.update('create index idx_comments_blog_id on comments (blog_id)')
+
+def _seed(users, blogs, comments):
+    """
+    写入测试数据，返回所有的id
+    """
+    ids = dict(users=[], blogs=[], comments=[])
+    with db.transaction():
+        for i in xrange(users):
+            u = User(email='user%d@example.com' % i, password='x' * 32, name='User %d' % i, image='about:blank')
+            u.insert()
+            ids['users'].append(u.id)
+        for i in xrange(blogs):
+            uid = random.choice(ids['users'])
+            b = Blog(user_id=uid, user_name='User', user_image='about:blank', name='Blog %d' % i,
+                     summary='summary ' * 10, content='content ' * 500)
+            b.insert()
+            ids['blogs'].append(b.id)
+        for i in xrange(comments):
+            c = Comment(blog_id=random.choice(ids['blogs']), user_id=random.choice(ids['users']),
+                        user_name='User', user_image='about:blank', content='comment ' * 20)
+            c.insert()
+            ids['comments'].append(c.id)
+    return ids
+
+def _time(fn, number, repeat):
+    """
+    返回repeat轮中最快一轮的每次调用耗时（微秒）
+    """
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        for j in xrange(number):
+            fn()
+        t = (timeit.default_timer() - start) / number
+        best = t if best is None else min(best, t)
+    return best * 1e6
+
+def _wsgi_call(app, path):
+    def start_response(status, headers):
+        if not status.startswith('200'):
+            raise RuntimeError('%s returns %s' % (path, status))
+    return ''.join(app({'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': ''}, start_response))
+
+class _DelayHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            time.sleep(float(line))
+            self.wfile.write('ok\n')
+            self.wfile.flush()
+
+def _start_delay_server():
+    """
+    在子进程中启动延迟服务器，返回(进程号, 地址)
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(w)
+        port = int(os.read(r, 16))
+        os.close(r)
+        return pid, ('127.0.0.1', port)
+    os.close(r)
+    server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), _DelayHandler)
+    server.daemon_threads = True
+    os.write(w, str(server.server_address[1]))
+    os.close(w)
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+def _concurrent(wsgi, path, concurrency, threads):
+    """
+    concurrency个请求同时请求path
+    sync模式与_PooledWSGIServer相同，由threads个线程处理；gevent模式与gevent worker相同，每个请求一个协程
+    """
+    errors = []
+    queue = Queue.Queue()
+    for i in range(concurrency):
+        queue.put(path)
+    def _request():
+        while True:
+            try:
+                p = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                _wsgi_call(wsgi, p)
+            except Exception, e:
+                errors.append(e)
+    n = concurrency if WORKER_CLASS == 'gevent' else min(threads, concurrency)
+    threads = [threading.Thread(target=_request) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+def _build_app(routes):
+    app = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+    # 先注册一批动态路由，模拟真实应用中需要逐个匹配的情况
+    for i in range(routes):
+        def _fn(arg):
+            return arg
+        app.add_url(get('/bench/filler%d/:arg' % i)(_fn))
+    app.add_module(sys.modules[__name__])
+    # 加入真实的路由和session拦截器
+    import urls
+    app.add_interceptor(urls.user_interceptor)
+    app.add_module(urls)
+    try:
+        import jinja2
+        from transwarp.web import jinja2TemplateEngine
+        app.template_engine = jinja2TemplateEngine(_TEMPLATES)
+    except ImportError:
+        logging.warning('jinja2 not installed, template benchmarks skipped')
+        app.template_engine = None
+    return app
+
+def run(args):
+    random.seed(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    driver = _CountingDriver()
+    # 并发测试中连接会在不同的线程间复用
+    db.create_engine(driver, database=path, pool_size=max(1, args.concurrency), prepared=not args.no_prepared, check_same_thread=False)
+    _create_tables()
+    ids = _seed(args.users, args.blogs, args.comments)
+    app = _build_app(args.routes)
+    template_engine = app.template_engine
+    wsgi = app.get_wsgi_application()
+    uid = ids['users'][0]
+    bid = ids['blogs'][0]
+    users = User.find_all()
+
+    def _insert():
+        # 插入到另一篇blog下，不影响其他测试的数据量
+        Comment(blog_id=ids['blogs'][-1], user_id=uid, user_name='User', user_image='about:blank', content='bench').insert()
+
+    def _wsgi_concurrent():
+        driver.latency = args.db_latency / 1000.0
+        try:
+            _concurrent(wsgi, '/bench/users/%s' % uid, args.concurrency, args.threads)
+        finally:
+            driver.latency = 0
+
+    def _insert_many():
+        Comment.insert_many(Comment(blog_id=ids['blogs'][-1], user_id=uid, user_name='User', user_image='about:blank', content='bench') for i in range(20))
+
+    cases = [
+        ('db.select', lambda: db.select('select * from blogs where user_id=?', uid)),
+        ('db.update', lambda: db.update('update users set name=? where id=?', 'User 0', uid)),
+        ('Model.get', lambda: User.get(uid)),
+        ('Model.find_by', lambda: Blog.find_by('where user_id=?', uid)),
+        ('Model.insert', _insert),
+        ('Model.insert_many', _insert_many),
+        ('route.static', lambda: app._match('GET', '/bench')),
+        ('route.dynamic', lambda: app._match('GET', '/bench/blogs/%s/comments' % bid)),
+        ('wsgi.user', lambda: _wsgi_call(wsgi, '/bench/users/%s' % uid)),
+        ('wsgi.comments', lambda: _wsgi_call(wsgi, '/bench/blogs/%s/comments' % bid)),
+    ]
+    if template_engine is not None:
+        cases.append(('template.users', lambda: template_engine('test_users.html', dict(users=users))))
+        cases.append(('wsgi.users', lambda: _wsgi_call(wsgi, '/')))
+    delay_pid = None
+    if args.concurrency:
+        # 每次操作是一批concurrency个并发请求
+        cases.append(('wsgi.concurrent', _wsgi_concurrent))
+        if args.db_latency:
+            delay_pid, driver.address = _start_delay_server()
+
+    results = {}
+    try:
+        for name, fn in cases:
+            if args.only and not name.startswith(args.only):
+                continue
+            parses = driver.parses
+            us = _time(fn, args.number, args.repeat)
+            parses = float(driver.parses - parses) / (args.number * args.repeat)
+            results[name] = dict(us_per_op=round(us, 3), ops_per_sec=round(1e6 / us, 1), parses_per_op=round(parses, 3))
+            print '%-20s %12.3f us/op %12.1f ops/s %8.2f parses/op' % (name, us, 1e6 / us, parses)
+    finally:
+        if delay_pid:
+            os.kill(delay_pid, signal.SIGTERM)
+            os.waitpid(delay_pid, 0)
+    return dict(meta=dict(python=platform.python_version(), platform=platform.platform(),
+                          time=time.time(), users=args.users, blogs=args.blogs,
+                          comments=args.comments, routes=args.routes, prepared=not args.no_prepared,
+                          worker_class=WORKER_CLASS, concurrency=args.concurrency, threads=args.threads,
+                          db_latency=args.db_latency), results=results)
+
+def compare(result, baseline, tolerance):
+    """
+    与baseline比较，返回变慢超过tolerance的项
+    """
+    regressions = []
+    for name, r in sorted(result['results'].iteritems()):
+        b = baseline['results'].get(name)
+        if not b:
+            continue
+        ratio = r['us_per_op'] / b['us_per_op']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-20s %12.3f -> %12.3f us/op  x%.2f%s' % (name, b['us_per_op'], r['us_per_op'], ratio, flag)
+    return regressions
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='transwarp benchmarks')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--blogs', type=int, default=1000)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--routes', type=int, default=20, help='number of filler dynamic routes')
+    parser.add_argument('--number', type=int, default=200, help='calls per round')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='run benchmarks whose name starts with this prefix')
+    parser.add_argument('--no-prepared', action='store_true', help='do not use prepared statements')
+    parser.add_argument('--concurrency', type=int, default=0, help='concurrent requests per op in wsgi.concurrent')
+    parser.add_argument('--db-latency', type=float, default=0, help='milliseconds per sql waited on a socket in wsgi.concurrent')
+    parser.add_argument('--threads', type=int, default=8, help='worker threads in sync mode, like server.threads')
+    parser.add_argument('--out', help='write results to this json file')
+    parser.add_argument('--baseline', help='compare with results in this json file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown ratio')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
@@ -1,6 +1,10 @@
 # config_default.py
 
 configs = {
+    'site': {
+        'name': 'Myblog',
+        'url': 'http://127.0.0.1:9000'
+    },
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
@@ -10,5 +14,47 @@ configs = {
     },
     'session': {
         'secret': 'yYsJsSo'
+    },
+    'server': {
+        'workers': 0,
+        'threads': 8,
+        'max_requests': 0
+    },
+    'metrics': {
+        'path': '/__metrics',
+        'share_dir': '/tmp/myblog-metrics',
+        'profile_dir': None,
+        'profile_every': 0,
+        'profile_threshold': None
+    },
+    'limiter': {
+        'limit': None,
+        'queue_size': 64,
+        'timeout': 1.0,
+        'retry_after': 1,
+        'adaptive': False
+    },
+    'search': {
+        'path': 'blogs.idx',
+        'save_interval': 300
+    },
+    'render': {
+        'cache_dir': 'render_cache'
+    },
+    'startup': {
+        'routes': 'routes.cache'
+    },
+    'schema': {
+        'queries': None
+    },
+    'bus': {
+        'path': '/tmp/myblog-bus',
+        'interval': 0.05
+    },
+    'jobs': {
+        'threads': 2,
+        'queue_size': 100,
+        'poll_interval': 1.0,
+        'keep_done': 86400
     }
 }
\ No newline at end of file
@@ -0,0 +1,71 @@
+# dbtool.py
+# -*- encoding: utf-8 -*-
+
+"""
+表结构工具
+    python dbtool.py ddl                      # 根据models.py输出建表语句，用于更新schema.sql
+    python dbtool.py diff [--drop] [--apply]  # 与数据库比较，输出（或执行）迁移sql
+    python dbtool.py advise --queries queries.log [--sql "select ..."] [--standin test.db]
+                                              # 根据记录的查询推荐索引
+查询记录由wsgiapp.py在配置了schema.queries时写入
+"""
+
+import sys
+import sqlite3
+import argparse
+
+from transwarp import db, schema
+from transwarp.jobs import Job
+from models import User, Blog, Comment
+from config import configs
+
+MODELS = (User, Blog, Comment, Job)
+
+def ddl(args):
+    for model in MODELS:
+        print schema.create_table(model, args.dialect)
+        print
+
+def diff(args):
+    db.create_engine(**configs.db)
+    L = schema.diff(MODELS, drop=args.drop)
+    for sql in L:
+        print sql
+    if args.apply:
+        with db.transaction():
+            for sql in L:
+                if not sql.startswith('--'):
+                    db.update(sql)
+    return 1 if any(not sql.startswith('--') for sql in L) and not args.apply else 0
+
+def advise(args):
+    queries = schema.QueryRecorder.load(args.queries) if args.queries else []
+    # 命令行给出的查询没有参数，占位符都用10代替（limit也需要整数）
+    queries.extend((sql, 1, 0.0, sql, (10, ) * sql.count('?')) for sql in args.sql or ())
+    conn = sqlite3.connect(args.standin) if args.standin else None
+    for r in schema.advise(MODELS, queries, conn=conn, rows=args.rows):
+        print r.sql
+        print '    %d calls, e.g. %s' % (r.calls, r.query)
+        print '    before: %8.3f ms  %s' % (r.before * 1000, r.plan_before)
+        print '    after:  %8.3f ms  %s' % (r.after * 1000, r.plan_after)
+        print '    estimated saving: %.3f s' % r.saving
+    return 0
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='schema sync and index advisor')
+    sub = parser.add_subparsers()
+    p = sub.add_parser('ddl', help='print create table statements')
+    p.add_argument('--dialect', default='mysql', choices=('mysql', 'sqlite'))
+    p.set_defaults(func=ddl)
+    p = sub.add_parser('diff', help='compare models with the live database')
+    p.add_argument('--drop', action='store_true', help='drop columns and indexes not in models')
+    p.add_argument('--apply', action='store_true', help='execute the migration')
+    p.set_defaults(func=diff)
+    p = sub.add_parser('advise', help='recommend indexes from recorded queries')
+    p.add_argument('--queries', help='path configured as schema.queries')
+    p.add_argument('--sql', action='append', help='analyze this query too')
+    p.add_argument('--standin', help='sqlite database to EXPLAIN on, default is a generated one')
+    p.add_argument('--rows', type=int, default=10000, help='rows per table in the generated database')
+    p.set_defaults(func=advise)
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,188 @@
+# feeds.py
+# -*- encoding: utf-8 -*-
+
+"""
+Atom feed和sitemap
+xml从数据库cursor逐行生成，边输出边缓存分块，blog没有变化时直接返回缓存的分块
+用最新的created_at、blog数量和最后一次清除缓存的时间作为ETag/Last-Modified，支持条件GET，
+修改blog不改变created_at和数量，所以要包括清除时间；清除时间在导入时初始化，重启后不会误判为未修改
+validator也缓存在内存中，和分块一起由ORM监听函数和InvalidationBus清除，条件GET不需要查询数据库
+"""
+
+import time
+import threading
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from xml.sax.saxutils import escape
+
+from transwarp import db, orm
+from transwarp.web import get, ctx, notfound
+from models import Blog
+from config import configs
+
+# 每个sitemap文件最多的URL数
+SITEMAP_LIMIT = 50000
+
+# feed中的blog数
+FEED_ENTRIES = 20
+
+class _ChunkCache(object):
+    """
+    缓存生成好的xml分块和当前的validator，validator不同或blog被修改时失效
+    """
+    def __init__(self):
+        self._data = {}
+        self._validator = None
+        # 每次clear()加1，查询validator期间被clear()时不保存查询结果
+        self._generation = 0
+        # 最后一次clear()的时间，prefork时在master中导入，各worker相同
+        self._changed_at = time.time()
+        self._lock = threading.Lock()
+
+    def validator(self, load):
+        with self._lock:
+            if self._validator is not None:
+                return self._validator
+            generation = self._generation
+            changed_at = self._changed_at
+        v = load() + (changed_at, )
+        with self._lock:
+            if generation == self._generation:
+                self._validator = v
+        return v
+
+    def get(self, key, validator):
+        with self._lock:
+            item = self._data.get(key)
+        if item and item[0] == validator:
+            return item[1]
+        return None
+
+    def set(self, key, validator, chunks):
+        with self._lock:
+            self._data[key] = (validator, chunks)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._validator = None
+            self._generation += 1
+            self._changed_at = time.time()
+
+_cache = _ChunkCache()
+
+def _on_model_change(action, model):
+    if isinstance(model, Blog):
+        _cache.clear()
+
+orm.add_model_listener(_on_model_change)
+
+def on_change(table, pk):
+    """
+    InvalidationBus的订阅函数
+    """
+    if table is None or table == Blog.__table__:
+        _cache.clear()
+
+def _url(path):
+    return escape(configs.site.url.rstrip('/') + path)
+
+def _isotime(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+def _load_validator():
+    d = db.select_one('select max(created_at) as latest, count(id) as total from blogs')
+    return (d.latest or 0.0, d.total)
+
+def _validator():
+    return _cache.validator(_load_validator)
+
+def _stream_and_cache(key, validator, chunks):
+    """
+    输出分块，全部输出后保存到缓存
+    """
+    L = []
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        L.append(chunk)
+        yield chunk
+    _cache.set(key, validator, L)
+
+def _serve(key, content_type, generate):
+    """
+    处理条件GET，返回缓存的分块或边生成边缓存的生成器
+    generate(total)返回xml分块的迭代器
+    """
+    validator = _validator()
+    latest, total, changed_at = validator
+    modified = max(latest, changed_at)
+    request, response = ctx.request, ctx.response
+    etag = '"%d-%d-%d"' % (int(latest * 1000), total, int(changed_at * 1000))
+    response.content_type = content_type
+    response.set_header('ETag', etag)
+    response.set_header('Last-Modified', formatdate(modified, usegmt=True))
+    if request.header('IF-NONE-MATCH') == etag:
+        response.status = 304
+        return []
+    since = parsedate_tz(request.header('IF-MODIFIED-SINCE') or '')
+    if since and request.header('IF-NONE-MATCH') is None and mktime_tz(since) >= int(modified):
+        response.status = 304
+        return []
+    chunks = _cache.get(key, validator)
+    if chunks is not None:
+        return chunks
+    return _stream_and_cache(key, validator, generate(total))
+
+def _feed(total):
+    yield u'<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield u'<title>%s</title>\n<id>%s</id>\n<link href="%s"/>\n<link rel="self" href="%s"/>\n' % (
+        escape(configs.site.name), _url('/'), _url('/'), _url('/feed'))
+    first = True
+    for b in db.select_iter('select id, user_name, name, summary, created_at from blogs order by created_at desc limit ?', FEED_ENTRIES):
+        if first:
+            yield u'<updated>%s</updated>\n' % _isotime(b.created_at)
+            first = False
+        link = _url('/blog/%s' % b.id)
+        yield u'<entry><title>%s</title><id>%s</id><link href="%s"/><updated>%s</updated><author><name>%s</name></author><summary>%s</summary></entry>\n' % (
+            escape(b.name), link, link, _isotime(b.created_at), escape(b.user_name), escape(b.summary))
+    yield u'</feed>\n'
+
+def _sitemap(page):
+    def _generate(total):
+        yield '<?xml version="1.0" encoding="utf-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        # 按created_at升序分页，新的blog只会改变最后一页
+        for b in db.select_iter('select id, created_at from blogs order by created_at, id limit ? offset ?', SITEMAP_LIMIT, page * SITEMAP_LIMIT):
+            yield '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (_url('/blog/%s' % b.id), _isotime(b.created_at))
+        yield '</urlset>\n'
+    return _generate
+
+def _sitemap_index(total):
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for page in range((total + SITEMAP_LIMIT - 1) // SITEMAP_LIMIT):
+        yield '<sitemap><loc>%s</loc></sitemap>\n' % _url('/sitemap-%d.xml' % page)
+    yield '</sitemapindex>\n'
+
+@get('/feed')
+def feed():
+    return _serve('feed', 'application/atom+xml; charset=utf-8', _feed)
+
+@get('/sitemap.xml')
+def sitemap():
+    """
+    不超过SITEMAP_LIMIT时直接是sitemap，否则是指向各个分页的sitemap索引
+    """
+    def _generate(total):
+        if total > SITEMAP_LIMIT:
+            return _sitemap_index(total)
+        return _sitemap(0)(total)
+    return _serve('sitemap', 'application/xml; charset=utf-8', _generate)
+
+@get('/sitemap-:page.xml')
+def sitemap_page(page):
+    if not page.isdigit():
+        raise notfound()
+    # 只缓存存在的分页，key用规范化的页号，缓存的条目数不超过分页数
+    page = int(page)
+    if page >= (_validator()[1] + SITEMAP_LIMIT - 1) // SITEMAP_LIMIT:
+        raise notfound()
+    return _serve('sitemap-%d' % page, 'application/xml; charset=utf-8', _sitemap(page))
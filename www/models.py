@@ -1,3 +1,4 @@
+# -*- encoding: utf-8 -*-
 import time, uuid
 
 from transwarp.db import next_id
@@ -5,6 +6,9 @@ from transwarp.orm import Model, StringField, BooleanField, FloatField, TextFiel
 
 class User(Model):
     __table__ = 'users'
+    __json_exclude__ = ('email', 'password')
+    __unique_indexes__ = ('email', )
+    __indexes__ = ('created_at', )
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(updatable=False, ddl='varchar(50)')
@@ -16,6 +20,7 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __indexes__ = ('created_at', 'user_id')
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(updatable=False, ddl='varchar(50)')
@@ -23,16 +28,18 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
     created_at = FloatField(updatable=False, default=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
+    # 每个blog页面按blog_id查询评论并按created_at排序
+    __indexes__ = ('created_at', ('blog_id', 'created_at'), 'user_id')
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(updatable=False, ddl='varchar(50)')
     user_id = StringField(updatable=False, ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
     created_at = FloatField(updatable=False, default=time.time)
\ No newline at end of file
@@ -0,0 +1,131 @@
+# render.py
+# -*- encoding: utf-8 -*-
+
+"""
+Blog内容渲染及缓存
+Blog.content为markdown，渲染结果包括html、摘要和目录
+缓存key为blog id，值为(内容的hash, 渲染结果)，hash不一致时重新渲染并覆盖，
+磁盘上每篇blog只有一个文件，修改后不会留下旧内容的文件；先查内存LRU，再查磁盘，Blog插入或修改时预先渲染
+"""
+
+import re
+import cgi
+import hashlib
+import logging
+import HTMLParser
+
+from transwarp import orm
+from transwarp.cache import LRUCache, DiskCache
+from models import Blog
+
+try:
+    import markdown
+except ImportError:
+    markdown = None
+    logging.warning('markdown not installed, using plain text renderer')
+
+_RE_HEADING = re.compile(r'^(#{1,6})\s+(.+?)\s*#*$')
+_RE_TAG = re.compile(r'<[^>]+>')
+_RE_SPACES = re.compile(r'\s+')
+
+def _to_unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s or u''
+
+def _render_plain(text):
+    """
+    没有markdown库时的渲染：支持#标题和空行分段，其余按纯文本转义
+    """
+    html = []
+    toc = []
+    para = []
+    def _flush():
+        if para:
+            html.append(u'<p>%s</p>' % u'<br/>'.join(cgi.escape(l) for l in para))
+            del para[:]
+    for line in text.splitlines():
+        m = _RE_HEADING.match(line)
+        if m:
+            _flush()
+            level, title = len(m.group(1)), m.group(2)
+            anchor = u'h-%d' % (len(toc) + 1)
+            toc.append((level, title, anchor))
+            html.append(u'<h%d id="%s">%s</h%d>' % (level, anchor, cgi.escape(title), level))
+        elif line.strip():
+            para.append(line)
+        else:
+            _flush()
+    _flush()
+    return u'\n'.join(html), toc
+
+def _render_markdown(text):
+    md = markdown.Markdown(extensions=['toc'])
+    html = md.convert(text)
+    toc = []
+    def _walk(tokens):
+        for t in tokens:
+            toc.append((t['level'], t['name'], t['id']))
+            _walk(t.get('children', []))
+    _walk(getattr(md, 'toc_tokens', []))
+    return html, toc
+
+def render(content, summary_length=200):
+    """
+    渲染blog内容，返回dict(html, summary, toc)
+    toc为[(级别, 标题, 锚点)]，summary为去掉标签后的前summary_length个字
+    """
+    text = _to_unicode(content)
+    html, toc = (_render_markdown if markdown else _render_plain)(text)
+    plain = _RE_SPACES.sub(u' ', HTMLParser.HTMLParser().unescape(_RE_TAG.sub(u' ', html))).strip()
+    summary = plain if len(plain) <= summary_length else plain[:summary_length] + u'...'
+    return dict(html=html, summary=summary, toc=toc)
+
+class RenderCache(object):
+    """
+    Blog渲染结果的两级缓存，cache_dir为None时只用内存
+    defer(fn, *args)在后台执行预先渲染，返回False时在当前线程渲染
+    """
+    def __init__(self, cache_dir=None, maxsize=256, defer=None):
+        self._memory = LRUCache(maxsize)
+        self._disk = DiskCache(cache_dir) if cache_dir else None
+        self._defer = defer
+        orm.add_model_listener(self._on_model_change)
+
+    def _digest(self, content):
+        return hashlib.sha1(content.encode('utf-8') if isinstance(content, unicode) else content).hexdigest()
+
+    def get(self, blog):
+        """
+        返回blog的渲染结果，没有缓存或内容已修改时渲染并缓存
+        """
+        digest = self._digest(blog.content)
+        item = self._memory.get(blog.id)
+        if item is None and self._disk:
+            item = self._disk.get(blog.id)
+            if item is not None:
+                self._memory.set(blog.id, item)
+        if item is None or item[0] != digest:
+            return self._put(blog.id, digest, blog.content)
+        return item[1]
+
+    def _put(self, blog_id, digest, content):
+        r = render(content)
+        item = (digest, r)
+        self._memory.set(blog_id, item)
+        if self._disk:
+            self._disk.set(blog_id, item)
+        return r
+
+    def invalidate(self, blog_id):
+        self._memory.delete(blog_id)
+        if self._disk:
+            self._disk.delete(blog_id)
+
+    def _on_model_change(self, action, model):
+        if not isinstance(model, Blog):
+            return
+        if action == 'delete':
+            self.invalidate(model.id)
+        elif not (self._defer and self._defer(self._put, model.id, self._digest(model.content), model.content)):
+            self._put(model.id, self._digest(model.content), model.content)
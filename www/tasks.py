@@ -0,0 +1,41 @@
+# tasks.py
+# -*- encoding: utf-8 -*-
+
+"""
+后台任务
+用户修改名字或头像后，由propagate_user任务分批更新blogs/comments中冗余的user_name/user_image
+"""
+
+import logging
+import functools
+
+from transwarp import db, orm
+from transwarp.jobs import JobExecutor, job, propagate
+from models import User, Blog, Comment
+from config import configs
+
+# 由wsgiapp启动，prefork时在每个worker中启动
+executor = JobExecutor(**configs.jobs)
+
+@job('propagate_user')
+def propagate_user(user_id):
+    user = User.get(user_id)
+    if user is None:
+        return
+    for model in (Blog, Comment):
+        propagate(model.__table__, 'user_id', user.id, dict(user_name=user.name, user_image=user.image))
+
+def _enqueue_propagate(user_id):
+    try:
+        executor.enqueue('propagate_user', (user_id, ), key='propagate_user:%s' % user_id)
+    except Exception:
+        # 用户的修改已经提交，入队失败不能让User.update()出错
+        logging.exception('Failed to enqueue propagate_user for user %s' % user_id)
+
+def _on_model_change(action, model):
+    if action == 'update' and isinstance(model, User):
+        # 同一用户未执行的任务合并为一个，执行时读取最新的名字和头像
+        # 修改提交后才入队，事务回滚时不入队，也不会在提交前就被执行而读到旧的名字
+        db.after_commit(functools.partial(_enqueue_propagate, model.id))
+
+orm.add_model_listener(_on_model_change)
@@ -0,0 +1,36 @@
+# test_limiter.py
+# -*- encoding: utf-8 -*-
+
+import time
+import unittest
+
+from transwarp.db import Dict
+from transwarp.limiter import AdmissionController
+
+def _request(limiter, path, latency):
+    # 直接构造token，模拟耗时latency秒的请求
+    limit, start = limiter.acquire()
+    limiter.release((limit, time.time() - latency), True, Dict(path=path))
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def test_mixed_latency_without_overload(self):
+        limiter = AdmissionController(limit=64, adaptive=True, exclude=('/__metrics', ))
+        _request(limiter, '/__metrics', 0.0005)
+        _request(limiter, '/blog/:blog_id', 0.0005)
+        for i in range(200):
+            _request(limiter, '/', 0.010)
+            _request(limiter, '/blog/:blog_id', 0.010)
+        self.assertEqual(limiter.stats()['global']['limit'], 64)
+
+    def test_backoff_when_saturated(self):
+        limiter = AdmissionController(limit=4, queue_size=0, adaptive=True)
+        for i in range(50):
+            tokens = [limiter.acquire() for j in range(limiter.stats()['global']['limit'])]
+            for limit, start in tokens:
+                # 并发用满时延迟随轮次升高
+                limiter.release((limit, time.time() - 0.001 * (i + 1)), True, Dict(path='/'))
+        self.assertEqual(limiter.stats()['global']['limit'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# test_search.py
+# -*- encoding: utf-8 -*-
+
+import unittest
+
+from transwarp.db import Dict
+from transwarp.search import SearchIndex
+
+class TestDeletedDocuments(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex(None, ('name', 'content'), listen=False)
+
+    def test_scores_positive_after_delete(self):
+        for i in range(30):
+            # 前20篇只有一次python，后10篇有两次
+            content = 'python python' if i >= 20 else 'python'
+            self.index.add(i, Dict(name='blog %d' % i, content=content))
+        for i in range(20):
+            self.index.remove(i)
+        results = self.index.search('python')
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(score > 0 for key, score in results))
+        self.assertEqual(sorted(key for key, score in results), range(20, 30))
+
+    def test_scores_positive_after_replace(self):
+        for i in range(5):
+            self.index.add(i, Dict(name='blog', content='python'))
+        # 反复修改同一篇，旧版本留在倒排表中
+        for j in range(20):
+            self.index.add(0, Dict(name='blog', content='python python'))
+        results = self.index.search('python')
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(score > 0 for key, score in results))
+        self.assertEqual(results[0][0], 0)
+        self.assertTrue(results[0][1] > results[1][1])
+
+if __name__ == '__main__':
+    unittest.main()
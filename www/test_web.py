@@ -0,0 +1,66 @@
+# test_web.py
+# -*- encoding: utf-8 -*-
+
+import unittest
+from StringIO import StringIO
+
+from transwarp.web import WSGIApplication, ctx, get
+from transwarp.limiter import AdmissionController
+from transwarp.metrics import Metrics
+
+@get('/stream')
+def stream():
+    # 生成器在wsgi()返回后才执行，执行时仍然可以使用ctx
+    yield 'path=%s;' % ctx.request.path_info
+    yield u'完成'
+
+@get('/broken')
+def broken():
+    yield 'partial'
+    raise ValueError('broken')
+
+def _environ(path):
+    return {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'wsgi.input': StringIO('')}
+
+class TestStreamingResponse(unittest.TestCase):
+
+    def setUp(self):
+        app = WSGIApplication('.')
+        app.add_url(stream)
+        app.add_url(broken)
+        app.limiter = AdmissionController(limit=4, queue_size=0)
+        app.metrics = Metrics(None)
+        self.app = app
+        self.wsgi = app.get_wsgi_application()
+        self.status = []
+
+    def _start_response(self, status, headers):
+        self.status.append(status)
+
+    def _in_flight(self):
+        return self.app.limiter.stats()['global']['in_flight']
+
+    def test_released_after_body_consumed(self):
+        body = self.wsgi(_environ('/stream'), self._start_response)
+        self.assertEqual(self.status, ['200 OK'])
+        # 响应体还没有输出，请求仍在进行中
+        self.assertEqual(self._in_flight(), 1)
+        self.assertEqual(''.join(body), 'path=/stream;' + u'完成'.encode('utf-8'))
+        self.assertEqual(self._in_flight(), 1)
+        body.close()
+        self.assertEqual(self._in_flight(), 0)
+        self.assertFalse(hasattr(ctx, 'request'))
+        self.assertIn('http_requests_total{worker=', self.app.metrics.render())
+        self.assertIn('route="/stream",status="200"} 1', self.app.metrics.render())
+
+    def test_error_while_streaming(self):
+        body = self.wsgi(_environ('/broken'), self._start_response)
+        it = iter(body)
+        self.assertEqual(next(it), 'partial')
+        self.assertRaises(ValueError, next, it)
+        body.close()
+        self.assertEqual(self._in_flight(), 0)
+        self.assertIn('route="/broken",status="500"} 1', self.app.metrics.render())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+# bus.py
+# -*- encoding: utf-8 -*-
+
+"""
+多进程之间的缓存失效通知
+    每条insert/update/delete语句产生(表名, 主键)事件，无法确定主键时主键为None，表示整个表
+    事件在写入提交后才发布（见db.after_commit），回滚的写入不产生事件，其他进程收到时能读到已提交的数据
+    事件先在本进程内同步分发，再合并成批，最多interval秒后通过Unix域数据报socket发给同一目录下的其他进程
+    每个进程在directory下绑定一个以进程号命名的socket，发送失败的socket被认为所在进程已退出，直接删除
+    每批带有发送方的序号，接收方发现丢失时分发(None, None)，订阅者应清空全部缓存
+订阅函数为fn(table, pk)，不需要外部服务，只能用于同一台机器上的多个进程
+已经通过ORM监听函数处理本进程写入的订阅者，可以用subscribe(fn, local=False)只接收其他进程的事件
+"""
+
+import os
+import re
+import time
+import errno
+import socket
+import marshal
+import logging
+import threading
+
+from transwarp import db, orm
+
+_RE_INSERT = re.compile(r'^\s*(?:insert|replace)\s+into\s+`?(\w+)`?\s*\(([^)]*)\)', re.IGNORECASE)
+_RE_BY_KEY = re.compile(r'^\s*(?:update\s+`?(\w+)`?\s+set\s+.+|delete\s+from\s+`?(\w+)`?)\s+where\s+`?(\w+)`?\s*=\s*(?:\?|%s)\s*$', re.IGNORECASE | re.DOTALL)
+_RE_BY_KEYS = re.compile(r'^\s*(?:update\s+`?(\w+)`?\s+set\s+.+|delete\s+from\s+`?(\w+)`?)\s+where\s+`?(\w+)`?\s+in\s*\(((?:\s*(?:\?|%s)\s*,)*\s*(?:\?|%s)\s*)\)\s*$', re.IGNORECASE | re.DOTALL)
+_RE_WRITE = re.compile(r'^\s*(?:update|delete\s+from|insert\s+into|replace\s+into)\s+`?(\w+)`?', re.IGNORECASE)
+
+def _primary_keys():
+    """
+    从所有Model子类得到{表名: 主键列名}
+    """
+    keys = {}
+    L = list(orm.Model.__subclasses__())
+    while L:
+        cls = L.pop()
+        keys[cls.__table__] = cls.__primary_key__.name
+        L.extend(cls.__subclasses__())
+    return keys
+
+class InvalidationBus(object):
+    """
+    directory为各进程socket所在的目录，ignore为不产生事件的表
+    一批中同一个表的主键超过max_keys个时合并为整个表的事件
+    """
+    def __init__(self, directory, interval=0.05, ignore=(), max_keys=256, batch_size=200):
+        self.directory = directory
+        self.interval = interval
+        self.ignore = set(ignore)
+        self.max_keys = max_keys
+        self.batch_size = batch_size
+        self._subscribers = []
+        self._keys = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sock = None
+        self._path = None
+        self._seq = 0
+        self._peers = {}
+        self._stats = dict(published=0, sent=0, received=0, dropped=0, gaps=0, max_lag=0.0)
+
+    def subscribe(self, fn, local=True):
+        self._subscribers.append((fn, local))
+
+    def start(self):
+        """
+        绑定本进程的socket并启动收发线程，prefork时在每个worker中fork之后调用
+        """
+        if self._sock is not None:
+            return
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # 其他进程已经创建
+                pass
+        self._path = os.path.join(self.directory, '%d.sock' % os.getpid())
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self._path)
+        self._sock = sock
+        self._seq = 0
+        self._peers = {}
+        for target in (self._receive_loop, self._flush_loop):
+            t = threading.Thread(target=target, name='bus')
+            t.daemon = True
+            t.start()
+
+    def on_sql(self, sql, args, elapsed):
+        """
+        用作db.add_sql_listener()的监听函数，事件在提交后发布
+        """
+        events = [e for e in self._parse(sql, args) if e[0] not in self.ignore]
+        if events:
+            db.after_commit(lambda: self._publish_all(events))
+
+    def _publish_all(self, events):
+        for table, pk in events:
+            self.publish(table, pk)
+
+    def _primary_key(self, table):
+        if table not in self._keys:
+            self._keys = _primary_keys()
+            self._keys.setdefault(table, None)
+        return self._keys[table]
+
+    def _parse(self, sql, args):
+        """
+        返回sql产生的事件列表
+        """
+        m = _RE_BY_KEY.match(sql)
+        if m:
+            table = m.group(1) or m.group(2)
+            return [(table, args[-1] if m.group(3) == self._primary_key(table) else None)]
+        m = _RE_BY_KEYS.match(sql)
+        if m:
+            table = m.group(1) or m.group(2)
+            n = m.group(4).count(',') + 1
+            if m.group(3) == self._primary_key(table) and len(args) >= n:
+                return [(table, pk) for pk in args[-n:]]
+            return [(table, None)]
+        m = _RE_INSERT.match(sql)
+        if m:
+            table = m.group(1)
+            cols = [c.strip().strip('`') for c in m.group(2).split(',')]
+            pk = self._primary_key(table)
+            return [(table, args[cols.index(pk)] if pk in cols and len(args) == len(cols) else None)]
+        m = _RE_WRITE.match(sql)
+        if m:
+            return [(m.group(1), None)]
+        return []
+
+    def publish(self, table, pk=None):
+        """
+        在本进程内分发事件，并加入下一批发给其他进程
+        """
+        self._dispatch([(table, pk)], False)
+        if self._sock is None:
+            return
+        with self._lock:
+            self._stats['published'] += 1
+            keys = self._pending.get(table)
+            if keys is None:
+                keys = self._pending[table] = set()
+            if None in keys:
+                return
+            if pk is None or len(keys) >= self.max_keys:
+                keys.clear()
+                keys.add(None)
+            else:
+                keys.add(pk)
+            full = sum(len(k) for k in self._pending.itervalues()) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _dispatch(self, events, remote=True):
+        for fn, local in self._subscribers:
+            if not (remote or local):
+                continue
+            for table, pk in events:
+                try:
+                    fn(table, pk)
+                except Exception:
+                    logging.exception('invalidation subscriber failed')
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('failed to flush invalidation events')
+
+    def flush(self):
+        """
+        把积累的事件发给其他进程
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        events = [(table, pk) for table, keys in pending.iteritems() for pk in keys]
+        if not events:
+            return
+        peers = [f for f in os.listdir(self.directory) if f.endswith('.sock')]
+        for i in xrange(0, len(events), self.batch_size):
+            self._seq += 1
+            data = marshal.dumps((os.getpid(), self._seq, time.time(), events[i:i + self.batch_size]))
+            for name in peers:
+                path = os.path.join(self.directory, name)
+                if path == self._path:
+                    continue
+                try:
+                    self._sock.sendto(data, socket.MSG_DONTWAIT, path)
+                    self._stats['sent'] += 1
+                except socket.error, e:
+                    if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        # 进程已退出
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    else:
+                        # 接收方的缓冲区满，由接收方根据序号发现丢失
+                        self._stats['dropped'] += 1
+
+    def _receive_loop(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+                pid, seq, ts, events = marshal.loads(data)
+            except Exception:
+                logging.exception('invalid invalidation message')
+                continue
+            last = self._peers.get(pid)
+            self._peers[pid] = seq
+            lag = time.time() - ts
+            self._stats['received'] += len(events)
+            self._stats['max_lag'] = max(self._stats['max_lag'], lag)
+            if last is not None and seq != last + 1:
+                self._stats['gaps'] += 1
+                self._dispatch([(None, None)])
+            else:
+                self._dispatch(events)
+
+    def stats(self):
+        return dict(self._stats)
+
+    def metrics(self):
+        """
+        文本格式的指标，可用Metrics.add_collector(bus.metrics)输出
+        """
+        s = self.stats()
+        L = ['# TYPE invalidation_events_total counter']
+        for name in ('published', 'received'):
+            L.append('invalidation_events_total{direction="%s"} %d' % (name, s[name]))
+        L.append('# TYPE invalidation_messages_total counter')
+        for name in ('sent', 'dropped', 'gaps'):
+            L.append('invalidation_messages_total{result="%s"} %d' % (name, s[name]))
+        L.append('# TYPE invalidation_lag_seconds_max gauge')
+        L.append('invalidation_lag_seconds_max %f' % s['max_lag'])
+        return L
@@ -0,0 +1,101 @@
+# cache.py
+# -*- encoding: utf-8 -*-
+
+"""
+缓存：进程内的LRU缓存和保存在磁盘上的缓存
+"""
+
+import os
+import time
+import marshal
+import hashlib
+import threading
+import collections
+
+class LRUCache(object):
+    """
+    线程安全的LRU缓存
+    maxsize为最多保存的条目数，ttl为条目过期的秒数，为None时不过期
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expires = item
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # 重新插入，移动到最近使用的一端
+            self._data[key] = item
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class DiskCache(object):
+    """
+    保存在目录中的缓存，每个条目一个文件，值用marshal序列化
+    只能保存dict/list/str等基本类型，写入时先写临时文件再改名，多进程共享也是安全的
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        name = hashlib.md5(key.encode('utf-8') if isinstance(key, unicode) else key).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, key, default=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return default
+
+    def set(self, key, value):
+        path = self._path(key)
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                # 其他进程已经创建
+                pass
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            marshal.dump(value, f)
+        os.rename(tmp, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
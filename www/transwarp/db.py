@@ -8,12 +8,21 @@ db模块
 
 import threading
 import functools
+import logging
+import collections
 import time
 import uuid
 
 # 全局变量 数据库连接
 engine = None
 
+# 全局变量 sql监听函数
+_sql_listeners = []
+
+# fork之后子进程从父进程继承的引擎和连接上下文，保留引用使其永远不被回收
+# 驱动在连接对象被回收时会close，发出的QUIT会关闭父进程和其他子进程共用的连接
+_inherited = []
+
 def next_id(t=None):
     """
     生成id：当前时间+随机数
@@ -22,19 +31,96 @@ def next_id(t=None):
         t = time.time()
     return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
-def create_engine(**kw):
+# 兼容MySQLdb参数的驱动
+_MYSQL_DRIVERS = ('MySQLdb', 'pymysql', 'mysql.connector')
+
+def _import(name):
+    return __import__(name, fromlist=[name.rsplit('.', 1)[-1]])
+
+def create_engine(driver='MySQLdb', pool_size=None, pool_recycle=3600, statement_cache=128, prepared=True, **kw):
     """
     创建数据库连接
+    driver为DB-API驱动的模块或模块名，默认MySQLdb，使用gevent时需要纯python的'pymysql'
+    其他驱动（如测试用的'sqlite3'）的参数原样传给connect()
+    pool_size为连接池保留的空闲连接数，MySQL驱动默认8，其他驱动默认0（不复用连接）
+    驱动支持cursor(prepared=True)（如'mysql.connector'）时使用服务端prepared statement，
+    每个连接按sql缓存最多statement_cache个，连接放回连接池后仍然有效
     """
-    import MySQLdb
     global engine
     if engine is not None:
         raise DBError('Engine is already initialized.')
+    name = driver if isinstance(driver, basestring) else driver.__name__
     params = kw
-    defaults = dict(host='127.0.0.1', port=3306,use_unicode=True, charset='utf8')
-    for k, v in defaults.iteritems():
-        params[k] = kw.pop(k, v)
-    engine = _Engine(lambda: MySQLdb.connect(**params))
+    options = dict(pool_recycle=pool_recycle, statement_cache=statement_cache, prepared=None if prepared else False)
+    if name in _MYSQL_DRIVERS:
+        defaults = dict(host='127.0.0.1', port=3306,use_unicode=True, charset='utf8')
+        for k, v in defaults.iteritems():
+            params[k] = kw.pop(k, v)
+        # MySQL驱动到第一次连接时才导入，加快启动
+        # 默认的cursor会把结果集全部读到客户端，select_iter()需要服务端cursor
+        connect = lambda: _import(name).connect(**params)
+        stream_cursor = None
+        if name != 'mysql.connector':
+            stream_cursor = lambda: _import(name + '.cursors').SSCursor
+        engine = _Engine(connect, 'format', stream_cursor, pool_size=8 if pool_size is None else pool_size, **options)
+        return
+    mod = _import(driver) if isinstance(driver, basestring) else driver
+    engine = _Engine(lambda: mod.connect(**params), getattr(mod, 'paramstyle', 'format'), pool_size=pool_size or 0, **options)
+
+def _convert(sql):
+    """
+    sql中统一用?作为占位符，按驱动的paramstyle转换
+    """
+    if engine.paramstyle == 'qmark':
+        return sql
+    return sql.replace('?', '%s')
+
+def reinit_after_fork():
+    """
+    fork之后在子进程中调用：丢弃从父进程继承的连接状态并重建引擎
+    继承来的连接socket与父进程共享，不能close，只能直接丢弃，并且要保留引用，避免被回收时关闭
+    """
+    global engine, _db_ctx
+    _inherited.append((engine, _db_ctx))
+    _db_ctx = _DbCtx()
+    if engine is not None:
+        engine = engine.copy()
+
+def close_pool():
+    """
+    关闭连接池中的空闲连接，prefork的master在fork之前调用，worker就不会继承这些连接
+    """
+    if engine is not None:
+        engine.close_pool()
+
+def add_sql_listener(fn):
+    """
+    注册监听函数fn(sql, args, elapsed)，每条sql执行后调用，用于统计耗时等
+    """
+    _sql_listeners.append(fn)
+
+def _notify(sql, args, start):
+    elapsed = time.time() - start
+    for fn in _sql_listeners:
+        fn(sql, args, elapsed)
+
+def after_commit(fn):
+    """
+    当前的写入提交后调用fn()，回滚时丢弃；不在连接上下文中时立即调用
+    在事务中时等最外层事务提交，否则等当前语句自动提交，用于在sql监听函数中发布写入事件
+    """
+    if _db_ctx.is_init():
+        _db_ctx.pending.append(fn)
+    else:
+        fn()
+
+def _run_after_commit():
+    pending, _db_ctx.pending = _db_ctx.pending, []
+    for fn in pending:
+        try:
+            fn()
+        except Exception:
+            logging.exception('after commit callback failed')
 
 def connection():
     """
@@ -70,15 +156,114 @@ def with_transaction(func):
 class DBError(Exception):
     pass
 
+class MultiColumnsError(DBError):
+    pass
+
 
 class _Engine(object):
     """
     数据库引擎对象
+    stream_cursor为返回服务端cursor类的函数，驱动不支持时为None
+    prepared为None时在第一次使用时检测驱动是否支持prepared statement
     """
-    def __init__(self, connect):
+    def __init__(self, connect, paramstyle='format', stream_cursor=None, pool_size=0, pool_recycle=3600, statement_cache=128, prepared=None):
         self._connect = connect
+        self.paramstyle = paramstyle
+        self.stream_cursor = stream_cursor
+        self.pool_size = pool_size
+        self.pool_recycle = pool_recycle
+        self.statement_cache = statement_cache
+        self.prepared = prepared if statement_cache else False
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def copy(self):
+        """
+        相同配置的新引擎，连接池为空
+        """
+        return _Engine(self._connect, self.paramstyle, self.stream_cursor, self.pool_size, self.pool_recycle, self.statement_cache, self.prepared)
+
     def connect(self):
-        return self._connect()
+        """
+        从连接池取连接，没有空闲连接或连接已超过pool_recycle秒时新建
+        """
+        while True:
+            with self._lock:
+                conn = self._pool.pop() if self._pool else None
+            if conn is None:
+                return _Connection(self._connect(), self.statement_cache)
+            if not self.pool_recycle or time.time() - conn.created < self.pool_recycle:
+                return conn
+            conn.close()
+
+    def close_pool(self):
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def release(self, conn):
+        """
+        把连接放回连接池，先回滚未结束的事务
+        """
+        if self.pool_size:
+            try:
+                conn.connection.rollback()
+            except Exception:
+                conn.close()
+                return
+            with self._lock:
+                if len(self._pool) < self.pool_size:
+                    self._pool.append(conn)
+                    return
+        conn.close()
+
+class _Connection(object):
+    """
+    数据库连接及其prepared statement缓存，缓存随连接放回连接池
+    """
+    def __init__(self, connection, statement_cache=128):
+        self.connection = connection
+        self.created = time.time()
+        self.statement_cache = statement_cache
+        self.statements = collections.OrderedDict()
+
+    def prepared(self, sql):
+        """
+        返回已经prepare了sql的cursor，驱动不支持时返回None
+        """
+        if not engine.prepared and engine.prepared is not None:
+            return None
+        cursor = self.statements.pop(sql, None)
+        if cursor is None:
+            try:
+                cursor = self.connection.cursor(prepared=True)
+            except TypeError:
+                logging.info('database driver does not support prepared statements')
+                engine.prepared = False
+                return None
+            engine.prepared = True
+            # 超过上限时关闭最久未使用的statement
+            while len(self.statements) >= self.statement_cache:
+                self.statements.popitem(last=False)[1].close()
+        self.statements[sql] = cursor
+        return cursor
+
+    def discard(self, sql):
+        cursor = self.statements.pop(sql, None)
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for sql in self.statements.keys():
+            self.discard(sql)
+        self.connection.close()
 
 class _LasyConnection(object):
     """
@@ -87,23 +272,34 @@ class _LasyConnection(object):
     def __init__(self):
         self.connection = None
 
-    def cursor(self):
+    def _get(self):
         if self.connection is None:
-            _connection = engine.connect()
-            self.connection = _connection
-        return self.connection.cursor()
+            self.connection = engine.connect()
+        return self.connection
+
+    def cursor(self, *args):
+        return self._get().connection.cursor(*args)
+
+    def prepared(self, sql):
+        return self._get().prepared(sql)
+
+    def discard(self, sql):
+        if self.connection:
+            self.connection.discard(sql)
 
     def commit(self):
-        self.connection.commit()
+        if self.connection:
+            self.connection.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            self.connection.connection.rollback()
 
     def cleanup(self):
         if self.connection:
             _connection = self.connection
             self.connection = None
-            _connection.close()
+            engine.release(_connection)
 
 class _DbCtx(threading.local):
     """
@@ -112,6 +308,7 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.pending = []
 
     def is_init(self):
         return not self.connection is None
@@ -119,10 +316,12 @@ class _DbCtx(threading.local):
     def init(self):
         self.connection = _LasyConnection()
         self.transactions = 0
+        self.pending = []
 
     def cleanup(self):
         self.connection.cleanup()
         self.connection = None
+        self.pending = []
 
     def cursor(self):
         return self.connection.cursor()
@@ -179,10 +378,13 @@ class _TransactionCtx(object):
             _db_ctx.connection.commit()
         except :
             _db_ctx.connection.rollback()
+            _db_ctx.pending = []
             raise
+        _run_after_commit()
 
     def rollback(self):
         global _db_ctx
+        _db_ctx.pending = []
         _db_ctx.connection.rollback()
 
 class Dict(dict):
@@ -203,27 +405,61 @@ class Dict(dict):
     def __setattr__(self, key, value):
         self[key] = value 
 
+def _execute(sql, args, many=False):
+    """
+    执行sql，返回(cursor, 是否prepared statement)
+    优先用连接缓存的prepared statement，参数以二进制协议发送；驱动不支持时用普通cursor
+    prepared statement的cursor由缓存管理，用完不能close
+    """
+    cursor = _db_ctx.connection.prepared(sql)
+    prepared = cursor is not None
+    if not prepared:
+        cursor = _db_ctx.connection.cursor()
+        sql = _convert(sql)
+    start = time.time()
+    try:
+        if many:
+            cursor.executemany(sql, args)
+        else:
+            cursor.execute(sql, args)
+    except:
+        if prepared:
+            _db_ctx.connection.discard(sql)
+        else:
+            cursor.close()
+        raise
+    if _sql_listeners:
+        if many:
+            elapsed = (time.time() - start) / max(len(args), 1)
+            for a in args:
+                for fn in _sql_listeners:
+                    fn(sql, a, elapsed)
+        else:
+            _notify(sql, args, start)
+    return cursor, prepared
+
 @with_connection
 def _select(sql, first, *args):
     """
     执行select语句，返回多个结果组成的列表
     """
     global _db_ctx
-    cursor = None
-    sql = sql.replace('?', '%s')
+    cursor, prepared = _execute(sql, args)
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
         if cursor.description:
             names = [x[0] for x in cursor.description]
-        if first:
+        # prepared statement的结果必须读完才能再次执行
+        if first and not prepared:
             values = cursor.fetchone()
             if not values:
                 return None
             return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+        rows = cursor.fetchall()
+        if first:
+            return Dict(names, rows[0]) if rows else None
+        return [Dict(names, x) for x in rows]
     finally:
-        if cursor:
+        if not prepared:
             cursor.close()
 
 def select_one(sql, *args):
@@ -238,27 +474,66 @@ def select_int(sql, *args):
 def select(sql, *args):
     return _select(sql, False, *args)
 
+def select_iter(sql, *args, **kw):
+    """
+    逐行返回select结果的生成器，每次从cursor取batch行，不会把整个结果集放进内存
+    迭代结束或生成器被close()之前一直占用数据库连接，期间同一线程不能执行其他sql
+    """
+    batch = kw.get('batch', 500)
+    sql = _convert(sql)
+    with _ConnectionCtx():
+        if engine.stream_cursor:
+            cursor = _db_ctx.connection.cursor(engine.stream_cursor())
+        else:
+            cursor = _db_ctx.connection.cursor()
+        try:
+            start = time.time()
+            cursor.execute(sql, args)
+            if _sql_listeners:
+                _notify(sql, args, start)
+            names = [x[0] for x in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                for values in rows:
+                    yield Dict(names, values)
+        finally:
+            cursor.close()
+
 @with_connection
-def _update(sql, *args):
+def _update(sql, args, many=False):
     """
     执行update语句，返回影响的行数
     """
     global _db_ctx
-    cursor = None
-    sql = sql.replace('?', '%s')
+    cursor, prepared = _execute(sql, args, many)
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
         r = cursor.rowcount
         if _db_ctx.transactions == 0:
-            _db_ctx.connection.commit()
+            try:
+                _db_ctx.connection.commit()
+            except:
+                _db_ctx.pending = []
+                raise
+            _run_after_commit()
         return r
     finally:
-        if cursor:
+        if not prepared:
             cursor.close()
 
 def update(sql, *args):
-    return _update(sql, *args)
+    return _update(sql, args)
+
+def update_many(sql, rows):
+    """
+    用多组参数执行同一条sql，用于批量insert
+    prepared statement只prepare一次，每组参数以二进制协议发送；否则由驱动的executemany()处理
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    return _update(sql, rows, True)
 
 if __name__=='__main__':
     create_engine('www-data', 'www-data', 'test')
@@ -0,0 +1,310 @@
+# jobs.py
+# -*- encoding: utf-8 -*-
+
+"""
+进程内的后台任务
+    @job('name')                    注册任务函数
+    executor.enqueue('name', args)  持久化的任务，保存在jobs表中，失败后按指数退避重试
+    executor.schedule('name', 60)   定时任务，多个进程同时运行时每个周期只执行一次
+    executor.defer(fn, *args)       不持久化的任务，队列满或executor未启动时返回False
+任务由固定数量的线程执行，队列有上限，轮询jobs表时只领取队列能容纳的任务
+"""
+
+import sys
+import time
+import heapq
+import Queue
+import logging
+import threading
+import traceback
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from transwarp import db
+from transwarp.db import next_id
+from transwarp.orm import Model, StringField, IntegerField, FloatField, TextField
+
+class Job(Model):
+    __table__ = 'jobs'
+    __indexes__ = (('status', 'run_at'), )
+
+    id = StringField(primary_key=True, default=next_id, ddl='varchar(100)')
+    name = StringField(ddl='varchar(100)')
+    args = TextField(ddl='mediumtext')
+    status = StringField(default='pending', ddl='varchar(20)')
+    attempts = IntegerField()
+    max_attempts = IntegerField(default=3)
+    run_at = FloatField(default=time.time)
+    locked_by = StringField(ddl='varchar(50)')
+    locked_at = FloatField()
+    last_error = TextField(ddl='mediumtext')
+    created_at = FloatField(updateable=False, default=time.time)
+
+# 全局变量 任务名到(函数, 最多尝试次数)
+_jobs = {}
+
+def job(name=None, max_attempts=3):
+    """
+    注册任务函数，参数必须能用json保存
+    """
+    def _decorator(func):
+        _jobs[name or func.__name__] = (func, max_attempts)
+        return func
+    return _decorator
+
+def _is_duplicate(e):
+    # 各驱动都按DB-API定义了IntegrityError
+    return e.__class__.__name__ == 'IntegrityError'
+
+def propagate(table, column, value, updates, pk='id', chunk=500, pause=0.0):
+    """
+    分批更新冗余字段：table中column=value的行改为updates中的新值
+    按主键顺序分页，每批最多chunk行，各自在一个事务中，返回更新的行数
+    不用col<>?筛选已是新值的行：按表的collation比较时，只改了大小写或末尾空格的新值会被当作相等
+    """
+    cols = sorted(updates)
+    values = [updates[c] for c in cols]
+    sets = ','.join('%s=?' % c for c in cols)
+    total = 0
+    last = ''
+    while True:
+        rows = db.select('select %s from %s where %s=? and %s>? order by %s limit %d' % (pk, table, column, pk, pk, chunk), value, last)
+        if not rows:
+            break
+        ids = [r[pk] for r in rows]
+        last = ids[-1]
+        with db.transaction():
+            total += db.update('update %s set %s where %s in (%s)' % (table, sets, pk, ','.join(['?'] * len(ids))), *(values + ids))
+        if len(rows) < chunk:
+            break
+        if pause:
+            time.sleep(pause)
+    return total
+
+@job('transwarp.jobs.cleanup')
+def cleanup(keep):
+    """
+    删除完成超过keep秒的任务
+    """
+    db.update('delete from jobs where status=? and locked_at<?', 'done', time.time() - keep)
+
+class JobExecutor(object):
+    """
+    threads为执行任务的线程数，queue_size为内存队列的上限
+    运行超过lock_timeout秒的任务被认为所在的进程已退出，重新执行
+    完成的任务保留keep_done秒，为0时不清理
+    """
+    def __init__(self, threads=2, queue_size=100, poll_interval=1.0, lock_timeout=300, retry_delay=5.0, keep_done=86400):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+        self.retry_delay = retry_delay
+        self.keep_done = keep_done
+        self._queue = Queue.Queue(queue_size)
+        self._schedule = []
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        """
+        启动轮询和执行线程，prefork时在每个worker中fork之后调用
+        """
+        if self._running:
+            return
+        self._running = True
+        if self.keep_done:
+            self.schedule('transwarp.jobs.cleanup', 3600, (self.keep_done, ))
+        self._threads = [threading.Thread(target=self._poll_loop, name='jobs-poll')]
+        for i in range(self.threads):
+            self._threads.append(threading.Thread(target=self._work, name='jobs-%d' % i))
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self, timeout=None):
+        """
+        停止领取新任务，等待队列中的任务执行完
+        """
+        if not self._running:
+            return
+        self._running = False
+        for i in range(self.threads):
+            self._queue.put(None)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def defer(self, fn, *args, **kw):
+        """
+        在后台线程中执行fn(*args, **kw)，不持久化也不重试
+        """
+        if not self._running:
+            return False
+        try:
+            self._queue.put_nowait(('defer', fn, args, kw))
+            return True
+        except Queue.Full:
+            return False
+
+    def enqueue(self, name, args=(), delay=0, key=None, max_attempts=None):
+        """
+        保存任务到jobs表，返回任务id
+        key为任务id，相同key的任务未执行时合并为一个；已执行或正在执行时重新执行一次
+        """
+        if name not in _jobs:
+            raise ValueError('Job not registered: %s' % name)
+        job = Job(id=key or next_id(), name=name, args=json.dumps(list(args)),
+                  max_attempts=max_attempts or _jobs[name][1], run_at=time.time() + delay)
+        if not self._insert(job):
+            db.update('update jobs set status=?, args=?, run_at=?, attempts=0, last_error=? where id=? and status<>?',
+                      'pending', job.args, job.run_at, '', job.id, 'pending')
+        return job.id
+
+    def _insert(self, job):
+        try:
+            job.insert()
+            return True
+        except Exception, e:
+            if not _is_duplicate(e):
+                raise
+            return False
+
+    def schedule(self, name, interval, args=()):
+        """
+        每interval秒执行一次，多个进程都调用时按周期编号作为任务id去重
+        """
+        if name not in _jobs:
+            raise ValueError('Job not registered: %s' % name)
+        with self._lock:
+            heapq.heappush(self._schedule, (time.time(), interval, name, tuple(args)))
+
+    def _run_schedule(self, now):
+        due = []
+        with self._lock:
+            while self._schedule and self._schedule[0][0] <= now:
+                t, interval, name, args = heapq.heappop(self._schedule)
+                heapq.heappush(self._schedule, (now + interval, interval, name, args))
+                due.append((interval, name, args))
+        for interval, name, args in due:
+            self._insert(Job(id='%s@%d' % (name, int(now // interval)), name=name, args=json.dumps(list(args)),
+                             max_attempts=_jobs[name][1], run_at=now))
+
+    def _poll_loop(self):
+        while self._running:
+            try:
+                with db.connection():
+                    now = time.time()
+                    self._run_schedule(now)
+                    self._recover(now)
+                    self._claim(now)
+            except Exception:
+                logging.exception('job polling failed')
+            time.sleep(self.poll_interval)
+
+    def _recover(self, now):
+        """
+        锁定超时的任务：已用完尝试次数的标记为失败，其余重新执行
+        """
+        expired = now - self.lock_timeout
+        db.update('update jobs set status=?, last_error=? where status=? and locked_at<? and attempts>=max_attempts',
+                  'failed', 'lock timeout', 'running', expired)
+        db.update('update jobs set status=? where status=? and locked_at<?', 'pending', 'running', expired)
+
+    def _claim(self, now):
+        free = self._queue.maxsize - self._queue.qsize()
+        if free <= 0:
+            return
+        for r in db.select('select id from jobs where status=? and run_at<=? order by run_at limit %d' % free, 'pending', now):
+            # 用条件更新领取任务，多个进程同时领取时只有一个成功
+            token = next_id()
+            if db.update('update jobs set status=?, locked_by=?, locked_at=?, attempts=attempts+1 where id=? and status=?',
+                         'running', token, now, r.id, 'pending') == 1:
+                j = db.select_one('select * from jobs where id=?', r.id)
+                self._queue.put(('job', j))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                if item[0] == 'defer':
+                    self._run_deferred(*item[1:])
+                else:
+                    with db.connection():
+                        self._run_job(item[1])
+            except Exception:
+                logging.exception('job failed')
+
+    def _run_deferred(self, fn, args, kw):
+        name = getattr(fn, '__name__', 'deferred')
+        start = time.time()
+        try:
+            fn(*args, **kw)
+        except Exception:
+            self._record(name, 'failed', time.time() - start)
+            raise
+        self._record(name, 'ok', time.time() - start)
+
+    def _run_job(self, j):
+        entry = _jobs.get(j.name)
+        start = time.time()
+        try:
+            if entry is None:
+                raise ValueError('Job not registered: %s' % j.name)
+            entry[0](*json.loads(j.args))
+        except Exception:
+            elapsed = time.time() - start
+            error = ''.join(traceback.format_exception(*sys.exc_info())[-3:])
+            if j.attempts < j.max_attempts:
+                self._record(j.name, 'retry', elapsed)
+                delay = self.retry_delay * 2 ** (j.attempts - 1)
+                db.update('update jobs set status=?, run_at=?, last_error=? where id=? and locked_by=?',
+                          'pending', time.time() + delay, error, j.id, j.locked_by)
+            else:
+                self._record(j.name, 'failed', elapsed)
+                db.update('update jobs set status=?, last_error=? where id=? and locked_by=?',
+                          'failed', error, j.id, j.locked_by)
+            logging.warning('job %s (%s) failed, attempt %d/%d:\n%s' % (j.name, j.id, j.attempts, j.max_attempts, error))
+            return
+        self._record(j.name, 'ok', time.time() - start)
+        # 执行期间被重新enqueue时状态已变为pending，不能覆盖
+        db.update('update jobs set status=?, last_error=? where id=? and locked_by=? and status=?',
+                  'done', '', j.id, j.locked_by, 'running')
+
+    def _record(self, name, result, elapsed):
+        with self._lock:
+            s = self._stats.get(name)
+            if s is None:
+                s = self._stats[name] = dict(ok=0, retry=0, failed=0, seconds=0.0, max=0.0)
+            s[result] += 1
+            s['seconds'] += elapsed
+            s['max'] = max(s['max'], elapsed)
+
+    def stats(self):
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._stats.iteritems())
+
+    def metrics(self):
+        """
+        文本格式的指标，可用Metrics.add_collector(executor.metrics)输出
+        """
+        stats = sorted(self.stats().iteritems())
+        L = ['# TYPE jobs_total counter']
+        for name, s in stats:
+            for result in ('ok', 'retry', 'failed'):
+                L.append('jobs_total{job="%s",result="%s"} %d' % (name, result, s[result]))
+        L.append('# TYPE job_duration_seconds_total counter')
+        for name, s in stats:
+            L.append('job_duration_seconds_total{job="%s"} %f' % (name, s['seconds']))
+        L.append('# TYPE job_duration_seconds_max gauge')
+        for name, s in stats:
+            L.append('job_duration_seconds_max{job="%s"} %f' % (name, s['max']))
+        L.append('# TYPE jobs_queued gauge')
+        L.append('jobs_queued %d' % self._queue.qsize())
+        return L
@@ -0,0 +1,162 @@
+# limiter.py
+# -*- encoding: utf-8 -*-
+
+"""
+并发限制和过载保护
+    全局和每个路由各有一个并发上限，超过上限的请求进入有界的等待队列
+    队列已满或等待超时的请求立即返回503和Retry-After，避免请求堆积在数据库连接上
+    adaptive=True时按观测到的延迟自动调整上限（AIMD）：
+        只在上限被用满（有请求在等待或并发数达到上限）时调整，否则延迟变化与并发无关
+        延迟不超过该路由的基准延迟*tolerance时，每个limit个请求上限加1
+        超过时或请求出错时，上限乘以backoff
+    基准延迟按路由分别记录，为观测到的最小延迟，缓慢向上衰减以适应负载变化
+    未匹配到路由的请求和exclude中的路由（如/__metrics）不参与调整
+limiter在处理请求的线程中执行，prefork的sync worker中并发数已被线程池限制为threads，
+limit不应超过threads，线程池前的排队和503由server._PooledWSGIServer处理
+"""
+
+import time
+import threading
+
+from transwarp.web import HttpError
+
+class _Limit(object):
+    """
+    单个并发限制
+    """
+    def __init__(self, name, limit, queue_size, timeout, adaptive=False,
+                 min_limit=1, max_limit=None, tolerance=2.0, backoff=0.9):
+        self.name = name
+        self.limit = float(limit)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit * 10
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        # 路由到基准延迟
+        self._baselines = {}
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """
+        返回是否获得执行许可
+        """
+        with self._cond:
+            if self.waiting == 0 and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            deadline = time.time() + self.timeout
+            try:
+                while self.in_flight >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, latency, ok, key=None):
+        with self._cond:
+            self.in_flight -= 1
+            if self.adaptive and ok is not None:
+                old = int(self.limit)
+                self._adjust(latency, ok, key)
+                if int(self.limit) > old:
+                    self._cond.notify_all()
+                    return
+            self._cond.notify()
+
+    def _adjust(self, latency, ok, key):
+        baseline = self._baselines.get(key)
+        if baseline is None or latency < baseline:
+            baseline = latency
+        else:
+            # 基准延迟缓慢上移，避免一次偶然的快请求永久压低上限
+            baseline = baseline * 1.001
+        self._baselines[key] = baseline
+        if self.waiting == 0 and self.in_flight + 1 < int(self.limit):
+            # 上限没有用满，请求之间没有排队
+            return
+        if not ok or latency > baseline * self.tolerance:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def stats(self):
+        with self._cond:
+            return dict(limit=int(self.limit), in_flight=self.in_flight, waiting=self.waiting,
+                        admitted=self.admitted, rejected=self.rejected, timeouts=self.timeouts)
+
+class AdmissionController(object):
+    """
+    WSGIApplication.limiter = AdmissionController()后生效
+    limit/queue_size/timeout为全局限制，set_route_limit()设置单个路由的限制
+    exclude为不参与自动调整的路由
+    """
+    def __init__(self, limit=64, queue_size=64, timeout=1.0, retry_after=1, adaptive=False, exclude=(), **kw):
+        self.retry_after = retry_after
+        self.exclude = set(exclude)
+        self._options = dict(adaptive=adaptive, **kw)
+        self._global = _Limit('global', limit, queue_size, timeout, **self._options)
+        self._routes = {}
+
+    def set_route_limit(self, path, limit, queue_size=None, timeout=None):
+        self._routes[path] = _Limit(path, limit,
+            self._global.queue_size if queue_size is None else queue_size,
+            self._global.timeout if timeout is None else timeout, **self._options)
+
+    def acquire(self, route=None):
+        """
+        获得全局（route为None时）或路由的执行许可，返回用于release()的token
+        无法获得时抛出503
+        """
+        limit = self._global if route is None else self._routes.get(route.path)
+        if limit is None:
+            return None
+        if not limit.acquire():
+            raise HttpError(503, [('Retry-After', str(self.retry_after))])
+        return (limit, time.time())
+
+    def release(self, token, ok=True, route=None):
+        """
+        ok为False表示请求出错，为None表示不计入延迟统计（如被路由限制拒绝的请求）
+        route为请求匹配到的路由，延迟与该路由自己的基准延迟比较
+        """
+        if token is not None:
+            limit, start = token
+            if route is None or route.path in self.exclude:
+                ok = None
+            limit.release(time.time() - start, ok, route.path if route else None)
+
+    def stats(self):
+        L = [self._global] + [self._routes[k] for k in sorted(self._routes)]
+        return dict((l.name, l.stats()) for l in L)
+
+    def metrics(self):
+        """
+        文本格式的指标，可用Metrics.add_collector(limiter.metrics)输出
+        """
+        L = []
+        stats = self.stats()
+        for name, typ in (('limit', 'gauge'), ('in_flight', 'gauge'), ('waiting', 'gauge'),
+                          ('admitted', 'counter'), ('rejected', 'counter'), ('timeouts', 'counter')):
+            L.append('# TYPE admission_%s %s' % (name, typ))
+            for scope in sorted(stats):
+                L.append('admission_%s{scope="%s"} %d' % (name, scope, stats[scope][name]))
+        return L
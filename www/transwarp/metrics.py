@@ -0,0 +1,331 @@
+# metrics.py
+# -*- encoding: utf-8 -*-
+
+"""
+请求级别的监控指标和采样profiler
+    每个路由的耗时直方图、状态码计数、进行中的请求数
+    每个路由在routing/handler/db/template各阶段的耗时
+    可选的文本格式（Prometheus exposition format）输出URL
+每行指标都带有worker="<pid>"标签，prefork时各worker的计数器是独立的，
+配置share_dir后每个worker把自己的指标定期写入share_dir，任意一个worker都输出全部worker的指标，
+用sum without(worker)(...)汇总
+"""
+
+import os
+import sys
+import time
+import errno
+import bisect
+import random
+import threading
+import logging
+import traceback
+
+from transwarp import db
+from transwarp.web import ctx, get
+
+# 默认的直方图分桶（秒）
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 未匹配到路由的请求
+_UNMATCHED = ('', 'unmatched')
+
+def _route_key(route):
+    return (route.method, route.path) if route else _UNMATCHED
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _add_label(line, label):
+    """
+    给一行指标加上标签，注释行不变
+    """
+    if not line or line.startswith('#'):
+        return line
+    name, sep, rest = line.partition('{')
+    if sep:
+        return '%s{%s,%s' % (name, label, rest)
+    name, sep, value = line.partition(' ')
+    return '%s{%s} %s' % (name, label, value)
+
+def _merge(texts):
+    """
+    合并多个worker的指标，同一指标的各行放在同一个TYPE注释下
+    """
+    families = {}
+    order = []
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith('# TYPE '):
+                family = line.split(' ')[2]
+                if family not in families:
+                    families[family] = [line]
+                    order.append(family)
+                continue
+            if family is None:
+                family = line.partition('{')[0].partition(' ')[0]
+                if family not in families:
+                    families[family] = []
+                    order.append(family)
+            families[family].append(line)
+    L = []
+    for family in order:
+        L.extend(families[family])
+    return L
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+def _on_sql(sql, args, elapsed):
+    request = getattr(ctx, 'request', None)
+    if request is not None:
+        request.add_timing('db', elapsed)
+
+db.add_sql_listener(_on_sql)
+
+class Metrics(object):
+    """
+    WSGIApplication.metrics = Metrics()后生效
+    path为指标输出的URL，为None时不输出
+    profiler为可选的SamplingProfiler
+    share_dir为prefork时各worker共享指标的目录，每个worker在请求结束时最多每interval秒写一次<pid>.prom，
+    输出时合并所有存活worker的文件，其他worker的指标最多落后interval秒
+    """
+    def __init__(self, path='/__metrics', buckets=_BUCKETS, profiler=None, share_dir=None, interval=5.0):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self.profiler = profiler
+        self.share_dir = share_dir
+        self.interval = interval
+        self._dumped_at = 0.0
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._phases = {}
+        self._status = {}
+        self._in_flight = {}
+        self._total_in_flight = 0
+        self._collectors = []
+        if share_dir and not os.path.isdir(share_dir):
+            os.makedirs(share_dir)
+
+    def add_collector(self, fn):
+        """
+        注册额外的指标，fn()返回文本格式的若干行
+        """
+        self._collectors.append(fn)
+
+    def request_started(self, request):
+        with self._lock:
+            self._total_in_flight += 1
+        if self.profiler:
+            self.profiler.start(request)
+
+    def route_matched(self, route):
+        key = _route_key(route)
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def request_finished(self, request, status, elapsed):
+        if self.profiler:
+            self.profiler.stop(request, elapsed)
+        key = _route_key(request.route)
+        timings = request.timings
+        db_time = timings.get('db', 0.0)
+        with self._lock:
+            self._total_in_flight -= 1
+            if request.route:
+                self._in_flight[key] -= 1
+            h = self._latency.get(key)
+            if h is None:
+                h = self._latency[key] = _Histogram(self.buckets)
+            h.observe(elapsed)
+            self._status[(key, status)] = self._status.get((key, status), 0) + 1
+            for phase, seconds in timings.iteritems():
+                if phase == 'handler':
+                    # handler的耗时不包括其中的数据库耗时
+                    seconds = max(seconds - db_time, 0.0)
+                self._phases[(key, phase)] = self._phases.get((key, phase), 0.0) + seconds
+        if self.share_dir and time.time() - self._dumped_at >= self.interval:
+            self.dump()
+
+    def dump(self):
+        """
+        把本进程的指标写入share_dir/<pid>.prom，先写临时文件再改名，其他worker不会读到一半
+        """
+        self._dumped_at = time.time()
+        name = os.path.join(self.share_dir, '%d.prom' % os.getpid())
+        try:
+            with open(name + '.tmp', 'w') as f:
+                f.write(self._render_local())
+            os.rename(name + '.tmp', name)
+        except (IOError, OSError):
+            logging.exception('Failed to dump metrics to %s' % name)
+
+    def render(self):
+        """
+        返回文本格式的全部指标，配置了share_dir时包括其他worker的指标
+        """
+        local = self._render_local()
+        if not self.share_dir:
+            return local
+        texts = [local]
+        pid = os.getpid()
+        for fname in sorted(os.listdir(self.share_dir)):
+            if not fname.endswith('.prom') or not fname[:-5].isdigit() or int(fname[:-5]) == pid:
+                continue
+            path = os.path.join(self.share_dir, fname)
+            if not _alive(int(fname[:-5])):
+                # 已退出的worker
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    texts.append(f.read())
+            except IOError:
+                continue
+        L = _merge(texts)
+        L.append('')
+        return '\n'.join(L)
+
+    def _render_local(self):
+        with self._lock:
+            latency = [(k, list(h.counts), h.sum, h.count) for k, h in sorted(self._latency.iteritems())]
+            status = sorted(self._status.iteritems())
+            phases = sorted(self._phases.iteritems())
+            in_flight = sorted(self._in_flight.iteritems())
+            total_in_flight = self._total_in_flight
+        L = ['# TYPE http_request_duration_seconds histogram']
+        for key, counts, total, count in latency:
+            labels = 'method="%s",route="%s"' % key
+            n = 0
+            for le, c in zip(self.buckets, counts):
+                n += c
+                L.append('http_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, n))
+            L.append('http_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, count))
+            L.append('http_request_duration_seconds_sum{%s} %f' % (labels, total))
+            L.append('http_request_duration_seconds_count{%s} %d' % (labels, count))
+        L.append('# TYPE http_requests_total counter')
+        for (key, code), n in status:
+            L.append('http_requests_total{method="%s",route="%s",status="%d"} %d' % (key + (code, n)))
+        L.append('# TYPE http_request_phase_seconds_total counter')
+        for (key, phase), seconds in phases:
+            L.append('http_request_phase_seconds_total{method="%s",route="%s",phase="%s"} %f' % (key + (phase, seconds)))
+        L.append('# TYPE http_requests_in_flight gauge')
+        L.append('http_requests_in_flight %d' % total_in_flight)
+        for key, n in in_flight:
+            L.append('http_requests_in_flight{method="%s",route="%s"} %d' % (key + (n,)))
+        for fn in self._collectors:
+            L.extend(fn())
+        label = 'worker="%d"' % os.getpid()
+        L = [_add_label(line, label) for line in L]
+        L.append('')
+        return '\n'.join(L)
+
+    def handler(self):
+        """
+        返回输出指标的URL处理函数
+        """
+        @get(self.path)
+        def _metrics():
+            ctx.response.content_type = 'text/plain; version=0.0.4'
+            return self.render()
+        return _metrics
+
+class SamplingProfiler(object):
+    """
+    采样profiler，结果写入dump_dir供离线分析：
+        every       每every个请求中随机一个用cProfile完整记录，写入*.prof，可用pstats/snakeviz查看
+        threshold   耗时超过threshold秒的请求，由后台线程每interval秒采样一次调用栈，
+                    写入*.stacks，每行为'栈;帧 次数'的折叠格式，可直接生成火焰图
+                    采样线程由start_sampler()启动，prefork时在每个worker中fork之后调用
+    """
+    def __init__(self, dump_dir, every=0, threshold=None, interval=0.01):
+        self.dump_dir = dump_dir
+        self.every = every
+        self.threshold = threshold
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = {}
+        self._sampler_pid = None
+        if not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+
+    def start_sampler(self):
+        """
+        启动采样线程，每个进程一个
+        fork时采样线程可能正持有锁，子进程继承的锁永远不会被释放，所以在子进程中重新创建
+        """
+        if self.threshold is None or self._sampler_pid == os.getpid():
+            return
+        self._lock = threading.Lock()
+        self._active = {}
+        self._sampler_pid = os.getpid()
+        t = threading.Thread(target=self._sample_loop, name='sampling-profiler')
+        t.daemon = True
+        t.start()
+
+    def start(self, request):
+        request.profile = None
+        request.stacks = None
+        if self.every and random.randint(1, self.every) == 1:
+            import cProfile
+            request.profile = cProfile.Profile()
+            request.profile.enable()
+        if self.threshold is not None:
+            request.stacks = {}
+            with self._lock:
+                self._active[threading.current_thread().ident] = (time.time(), request)
+
+    def stop(self, request, elapsed):
+        if request.profile is not None:
+            request.profile.disable()
+            request.profile.dump_stats(self._filename(request, 'prof'))
+        if request.stacks is not None:
+            with self._lock:
+                self._active.pop(threading.current_thread().ident, None)
+            if elapsed >= self.threshold and request.stacks:
+                with open(self._filename(request, 'stacks'), 'w') as f:
+                    for stack, n in sorted(request.stacks.iteritems()):
+                        f.write('%s %d\n' % (stack, n))
+
+    def _filename(self, request, ext):
+        route = request.route.path if request.route else 'unmatched'
+        name = '%d-%d-%s.%s' % (int(time.time() * 1000), os.getpid(), route.strip('/').replace('/', '_') or 'index', ext)
+        return os.path.join(self.dump_dir, name)
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self._lock:
+                active = [(tid, request) for tid, (start, request) in self._active.iteritems() if now - start >= self.threshold]
+            if not active:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for tid, request in active:
+                    frame = frames.get(tid)
+                    # 采样期间请求可能已经结束
+                    if frame is None or self._active.get(tid, (0, None))[1] is not request:
+                        continue
+                    stack = ';'.join('%s:%s' % (os.path.basename(f[0]), f[2]) for f in traceback.extract_stack(frame))
+                    request.stacks[stack] = request.stacks.get(stack, 0) + 1
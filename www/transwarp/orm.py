@@ -10,9 +10,28 @@ import db
 import time
 from db import next_id
 
+# 全局变量 Model写入监听函数
+_model_listeners = []
+
+def add_model_listener(fn):
+    """
+    注册监听函数fn(action, model)，action为'insert'/'update'/'delete'
+    在通过Model写入数据库之后调用，用于缓存失效等
+    """
+    _model_listeners.append(fn)
+
+def _notify(action, model):
+    for fn in _model_listeners:
+        fn(action, model)
+
 class Field(object):
 
+    # 字段创建的计数，用于按定义顺序输出DDL
+    _count = 0
+
     def __init__(self, **kw):
+        self._order = Field._count
+        Field._count = Field._count + 1
         self.name = kw.get('name', None)
         self._default = kw.get('default', None)
         self.primary_key = kw.get('primary_key', False)
@@ -107,6 +126,9 @@ class ModelMetaclass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
+        # 可以输出为json的字段，__json_exclude__中的字段（如密码）除外
+        exclude = attrs.get('__json_exclude__', ())
+        attrs['__json_fields__'] = tuple(k for k in sorted(mappings) if k not in exclude)
         return type.__new__(cls, name, bases, attrs)
 
 class Model(dict):
@@ -158,36 +180,59 @@ class Model(dict):
     def count_by(cls, where, *args):
         return db.select('select count(%s) from %s %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
 
-    def insert(self):
-        fields = []
-        params = []
+    def _insert_args(self):
         args = []
         for k, v in self.__mappings__.iteritems():
             tmp = getattr(self, k, None)
             if not tmp:
-                tmp = self.__mappings__[k].default
+                tmp = v.default
                 self[k]=tmp
-            fields.append(v.name)
-            params.append('?')
             args.append(tmp)
-        sql = 'insert into %s (%s) values (%s)' % (self.__table__, ','.join(fields), ','.join(params))
-        return db.update(sql, *args)
+        return args
+
+    @classmethod
+    def _insert_sql(cls):
+        fields = [v.name for v in cls.__mappings__.itervalues()]
+        return 'insert into %s (%s) values (%s)' % (cls.__table__, ','.join(fields), ','.join(['?'] * len(fields)))
+
+    def insert(self):
+        r = db.update(self._insert_sql(), *self._insert_args())
+        _notify('insert', self)
+        return r
+
+    @classmethod
+    def insert_many(cls, models):
+        """
+        批量insert，同一条sql用db.update_many()执行
+        """
+        models = list(models)
+        r = db.update_many(cls._insert_sql(), [m._insert_args() for m in models])
+        for m in models:
+            _notify('insert', m)
+        return r
 
     def delete(self):
         pk = self.__primary_key__.name
         args = (getattr(self, pk), )
         sql = 'delete from %s where %s=?' % (self.__table__, pk)
-        return db.update(sql, *args)
+        r = db.update(sql, *args)
+        _notify('delete', self)
+        return r
 
     def update(self):
         pk = self.__primary_key__.name
         args = (getattr(self, pk), )
         key_value = []
+        values = []
         for k, v in self.__mappings__.iteritems():
-            if self.__mappings__[k].updateable:   
-                key_value.append(v.name+'=\''+str(getattr(self, k, None))+'\'')
+            if self.__mappings__[k].updateable:
+                # 值作为参数传递，每个表只有一条update语句，可以复用prepared statement
+                key_value.append(v.name+'=?')
+                values.append(getattr(self, k, None))
         sql = 'update %s set %s where %s=?' % (self.__table__, ','.join(key_value), pk)
-        return db.update(sql, *args)
+        r = db.update(sql, *(values + list(args)))
+        _notify('update', self)
+        return r
 
 class User(Model):
     __table__ = 'users'
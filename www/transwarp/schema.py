@@ -0,0 +1,445 @@
+# schema.py
+# -*- encoding: utf-8 -*-
+
+"""
+表结构同步和索引建议
+    create_table(model)         根据Model.__mappings__和字段的ddl生成建表语句
+    diff(models)                与数据库中的实际表结构比较，返回迁移用的sql
+    QueryRecorder               作为db.add_sql_listener()的监听函数记录select语句
+    advise(models, queries)     分析查询的where/order by，在本地sqlite替身库上用EXPLAIN估计索引的效果
+Model可以用__indexes__声明索引，每项为列名或列名的tuple，__unique_indexes__为唯一索引
+"""
+
+import os
+import re
+import glob
+import time
+import random
+import marshal
+import logging
+import threading
+
+from transwarp import db
+
+def _q(name):
+    # MySQL和sqlite都支持反引号
+    return '`%s`' % name
+
+def fields(model):
+    """
+    按定义顺序返回Model的字段
+    """
+    return sorted(model.__mappings__.itervalues(), key=lambda f: f._order)
+
+def model_indexes(model):
+    """
+    返回Model声明的索引[(名称, 列, 是否唯一)]，名称为idx_加列名
+    """
+    L = []
+    for unique, specs in ((True, getattr(model, '__unique_indexes__', ())), (False, getattr(model, '__indexes__', ()))):
+        for spec in specs:
+            cols = (spec, ) if isinstance(spec, basestring) else tuple(spec)
+            L.append(('idx_' + '_'.join(cols), cols, unique))
+    return L
+
+def _column(f):
+    return '%s %s %s' % (_q(f.name), f.ddl, 'null' if f.nullable else 'not null')
+
+def create_table(model, dialect='mysql'):
+    """
+    生成建表语句，sqlite的索引需要单独用create_indexes()创建
+    """
+    L = [_column(f) for f in fields(model)]
+    if dialect == 'mysql':
+        for name, cols, unique in model_indexes(model):
+            L.append('%skey %s (%s)' % ('unique ' if unique else '', _q(name), ','.join(_q(c) for c in cols)))
+    L.append('primary key (%s)' % _q(model.__primary_key__.name))
+    sql = 'create table %s (\n    %s\n)' % (_q(model.__table__), ',\n    '.join(L))
+    if dialect == 'mysql':
+        sql = sql + ' engine=innodb default charset=utf8'
+    return sql + ';'
+
+def _index_name(table, name, dialect):
+    # sqlite的索引名在整个库中唯一，加上表名作为前缀
+    return name if dialect == 'mysql' else '%s_%s' % (table, name)
+
+def _add_index(table, name, cols, unique, dialect):
+    cols = ','.join(_q(c) for c in cols)
+    if dialect == 'mysql':
+        return 'alter table %s add %skey %s (%s);' % (_q(table), 'unique ' if unique else '', _q(name), cols)
+    return 'create %sindex %s on %s (%s);' % ('unique ' if unique else '', _q(name), _q(table), cols)
+
+def _drop_index(table, name, dialect):
+    if dialect == 'mysql':
+        return 'alter table %s drop key %s;' % (_q(table), _q(name))
+    return 'drop index %s;' % _q(name)
+
+def create_indexes(model, dialect='sqlite'):
+    table = model.__table__
+    return [_add_index(table, _index_name(table, name, dialect), cols, unique, dialect) for name, cols, unique in model_indexes(model)]
+
+def _literal(f):
+    # sqlite添加not null的列必须有默认值
+    d = f.default
+    if isinstance(d, bool):
+        return str(int(d))
+    if isinstance(d, (int, long, float)):
+        return repr(d)
+    return "'%s'" % (d or '').replace("'", "''")
+
+_RE_INT_WIDTH = re.compile(r'^(tinyint|smallint|mediumint|int|integer|bigint)\(\d+\)')
+
+_TYPE_ALIASES = {
+    'bool': 'tinyint',
+    'boolean': 'tinyint',
+    'real': 'double',
+    'integer': 'int',
+}
+
+def _normalize_type(t):
+    """
+    统一类型的写法：MySQL中bool为tinyint(1)，real为double，整数类型的显示宽度不影响存储
+    """
+    t = ' '.join(t.lower().split())
+    t = _RE_INT_WIDTH.sub(r'\1', t)
+    return _TYPE_ALIASES.get(t, t)
+
+def _dialect():
+    # sqlite3的paramstyle为qmark，MySQL驱动为format
+    return 'sqlite' if db.engine.paramstyle == 'qmark' else 'mysql'
+
+def live_schema(dialect=None):
+    """
+    读取数据库中的表结构：{表名: Dict(columns={列名: 类型}, indexes={索引名: (列, 是否唯一)})}
+    主键不在indexes中
+    """
+    dialect = dialect or _dialect()
+    tables = {}
+    if dialect == 'mysql':
+        for t in db.select('select table_name as name from information_schema.tables where table_schema=database()'):
+            tables[t.name] = db.Dict(columns={}, indexes={})
+        for c in db.select('select table_name as tbl, column_name as name, column_type as type from information_schema.columns where table_schema=database() order by ordinal_position'):
+            if c.tbl in tables:
+                tables[c.tbl].columns[c.name] = c.type
+        for i in db.select('select table_name as tbl, index_name as name, column_name as col, non_unique as non_unique from information_schema.statistics where table_schema=database() order by index_name, seq_in_index'):
+            if i.tbl in tables and i.name != 'PRIMARY':
+                cols, unique = tables[i.tbl].indexes.get(i.name, ((), not i.non_unique))
+                tables[i.tbl].indexes[i.name] = (cols + (i.col, ), unique)
+        return tables
+    for t in db.select("select name from sqlite_master where type='table' and name not like 'sqlite_%'"):
+        info = tables[t.name] = db.Dict(columns={}, indexes={})
+        for c in db.select('pragma table_info(%s)' % _q(t.name)):
+            info.columns[c.name] = c.type
+        for i in db.select('pragma index_list(%s)' % _q(t.name)):
+            if i.name.startswith('sqlite_autoindex_'):
+                continue
+            cols = tuple(c.name for c in db.select('pragma index_info(%s)' % _q(i.name)))
+            info.indexes[i.name] = (cols, bool(i.unique))
+    return tables
+
+def diff(models, dialect=None, drop=False):
+    """
+    比较Model与数据库中的表结构，返回迁移用的sql列表
+    多出的表、列和索引默认只输出注释，drop为True时才删除；sqlite不能修改列类型，也只输出注释
+    """
+    dialect = dialect or _dialect()
+    live = live_schema(dialect)
+    L = []
+    for model in models:
+        table = model.__table__
+        info = live.get(table)
+        if info is None:
+            L.append(create_table(model, dialect))
+            if dialect != 'mysql':
+                L.extend(create_indexes(model, dialect))
+            continue
+        for f in fields(model):
+            t = info.columns.get(f.name)
+            if t is None:
+                sql = 'alter table %s add column %s' % (_q(table), _column(f))
+                if dialect != 'mysql' and not f.nullable:
+                    sql = sql + ' default %s' % _literal(f)
+                L.append(sql + ';')
+            elif _normalize_type(t) != _normalize_type(f.ddl):
+                if dialect == 'mysql':
+                    L.append('alter table %s modify column %s;' % (_q(table), _column(f)))
+                else:
+                    L.append('-- %s.%s is %s, model defines %s' % (table, f.name, t, f.ddl))
+        names = set(f.name for f in model.__mappings__.itervalues())
+        for col in info.columns:
+            if col not in names:
+                if drop:
+                    L.append('alter table %s drop column %s;' % (_q(table), _q(col)))
+                else:
+                    L.append('-- %s.%s is not defined in model' % (table, col))
+        declared = [(_index_name(table, name, dialect), cols, unique) for name, cols, unique in model_indexes(model)]
+        for name, cols, unique in declared:
+            existing = info.indexes.get(name)
+            if existing == (cols, unique):
+                continue
+            if existing:
+                L.append(_drop_index(table, name, dialect))
+            L.append(_add_index(table, name, cols, unique, dialect))
+        declared_names = set(name for name, cols, unique in declared)
+        for name, (cols, unique) in sorted(info.indexes.iteritems()):
+            if name not in declared_names:
+                if drop:
+                    L.append(_drop_index(table, name, dialect))
+                else:
+                    L.append('-- index %s.%s (%s) is not defined in model' % (table, name, ','.join(cols)))
+    return L
+
+_RE_SPACES = re.compile(r'\s+')
+_RE_IN_LIST = re.compile(r'in\s*\(\s*\?(\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
+def _normalize_sql(sql):
+    """
+    统一占位符和空白，in (?,?,...)合并为in (?)，参数个数不同的同一查询只记录一次
+    """
+    sql = _RE_SPACES.sub(' ', sql.replace('%s', '?')).strip()
+    return _RE_IN_LIST.sub('in (?)', sql)
+
+class QueryRecorder(object):
+    """
+    记录select语句的次数和耗时，用作db.add_sql_listener()的监听函数
+    path不为None时每隔interval秒保存一次，每个进程保存为path.进程号，load()时合并
+    """
+    def __init__(self, path=None, interval=60, maxsize=1000):
+        self.path = path
+        self.interval = interval
+        self.maxsize = maxsize
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._saved = time.time()
+
+    def __call__(self, sql, args, elapsed):
+        if sql.lstrip()[:6].lower() != 'select':
+            return
+        key = _normalize_sql(sql)
+        with self._lock:
+            s = self._stats.get(key)
+            if s is None:
+                if len(self._stats) >= self.maxsize:
+                    return
+                # 保留一组原始的sql和参数，分析时在替身库上执行
+                s = self._stats[key] = [0, 0.0, sql.replace('%s', '?'), tuple(args)]
+            s[0] += 1
+            s[1] += elapsed
+        if self.path and time.time() - self._saved > self.interval:
+            self.save()
+
+    def queries(self):
+        """
+        返回[(sql, 次数, 总耗时, 示例sql, 示例参数)]
+        """
+        with self._lock:
+            return [(k, s[0], s[1], s[2], s[3]) for k, s in self._stats.iteritems()]
+
+    def save(self, path=None):
+        path = '%s.%d' % (path or self.path, os.getpid())
+        self._saved = time.time()
+        data = self.queries()
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                marshal.dump(data, f)
+            os.rename(tmp, path)
+        except (IOError, OSError, ValueError), e:
+            logging.warning('failed to save queries to %s: %s' % (path, e))
+
+    @staticmethod
+    def load(path):
+        """
+        读取并合并path.*中各进程记录的查询
+        """
+        stats = {}
+        for fname in glob.glob(path + '.*'):
+            if fname.endswith('.tmp'):
+                continue
+            with open(fname, 'rb') as f:
+                for key, calls, elapsed, sql, args in marshal.load(f):
+                    s = stats.setdefault(key, [0, 0.0, sql, args])
+                    s[0] += calls
+                    s[1] += elapsed
+        return [(k, s[0], s[1], s[2], s[3]) for k, s in stats.iteritems()]
+
+_RE_SELECT = re.compile(r'^select .+? from `?(\w+)`?(?: (?:as )?(\w+))?(?: where (.+?))?(?: group by .+?)?(?: order by (.+?))?(?: limit .+)?$', re.IGNORECASE)
+_RE_PREDICATE = re.compile(r'^`?(?:\w+\.)?(\w+)`?\s*(=|<=|>=|<>|!=|<|>| in\b| like\b| between\b| is\b)', re.IGNORECASE)
+_RE_ORDER = re.compile(r'^`?(?:\w+\.)?(\w+)`?(?:\s+(asc|desc))?$', re.IGNORECASE)
+_RE_SPLIT_AND = re.compile(r'\s+and\s+', re.IGNORECASE)
+
+def parse_query(sql):
+    """
+    分析单表查询，返回(表名, 等值条件的列, 范围条件的列, order by的列)，无法分析时返回None
+    """
+    sql = _normalize_sql(sql)
+    if '(select' in sql.lower() or ' join ' in sql.lower():
+        return None
+    m = _RE_SELECT.match(sql)
+    if not m:
+        return None
+    table, alias, where, order = m.groups()
+    if alias and alias.lower() in ('where', 'order', 'limit', 'group'):
+        return None
+    eq, ranges, orders = [], [], []
+    if where:
+        if re.search(r'\bor\b', where, re.IGNORECASE):
+            return None
+        # between ? and ?中的and不是条件的分隔
+        where = re.sub(r'(?i)between \? and \?', 'between ?', where)
+        for p in _RE_SPLIT_AND.split(where):
+            pm = _RE_PREDICATE.match(p.strip().strip('()'))
+            if not pm:
+                continue
+            col, op = pm.group(1), pm.group(2).strip().lower()
+            if op in ('=', 'in', 'is'):
+                if col not in eq:
+                    eq.append(col)
+            elif op not in ('<>', '!='):
+                if col not in ranges:
+                    ranges.append(col)
+    if order:
+        directions = set()
+        for o in order.split(','):
+            om = _RE_ORDER.match(o.strip())
+            if not om:
+                orders = []
+                break
+            orders.append(om.group(1))
+            directions.add((om.group(2) or 'asc').lower())
+        # 方向不一致时索引无法同时满足排序
+        if len(directions) > 1:
+            orders = []
+    return table, eq, ranges, orders
+
+def _candidate(eq, ranges, orders):
+    """
+    推荐的索引列：等值条件的列在前，然后是第一个范围条件的列，没有范围条件时接上排序的列
+    """
+    cols = list(eq)
+    if ranges:
+        if ranges[0] not in cols:
+            cols.append(ranges[0])
+    else:
+        for c in orders:
+            if c not in cols:
+                cols.append(c)
+    return tuple(cols)
+
+def _serves(index, candidate, eq_count):
+    """
+    index的前缀能否满足candidate：前eq_count列顺序可以不同
+    """
+    k = min(eq_count, len(candidate))
+    return len(index) >= len(candidate) and set(index[:k]) == set(candidate[:k]) and tuple(index[k:len(candidate)]) == tuple(candidate[k:])
+
+def _rows(model, n):
+    """
+    替身库中的测试数据，主键和唯一索引以外的列约有n/20个不同的值
+    """
+    distinct = max(n // 20, 1)
+    fs = fields(model)
+    unique = set(cols[0] for name, cols, u in model_indexes(model) if u and len(cols) == 1)
+    for i in xrange(n):
+        row = []
+        for f in fs:
+            d = f._default
+            if f.primary_key or f.name in unique:
+                row.append(u'%s-%08d' % (f.name, i))
+            elif isinstance(d, bool):
+                row.append(i % 2)
+            elif isinstance(d, (int, long, float)) or (callable(d) and f.ddl == 'real'):
+                row.append(float(random.randint(0, distinct)))
+            else:
+                row.append(u'%s-%d' % (f.name, random.randint(0, distinct)))
+        yield row
+
+def create_standin(models, path=':memory:', rows=10000):
+    """
+    创建sqlite替身库：按Model建表、建索引，写入rows行测试数据
+    """
+    import sqlite3
+    conn = sqlite3.connect(path)
+    for model in models:
+        conn.execute(create_table(model, 'sqlite'))
+        for sql in create_indexes(model, 'sqlite'):
+            conn.execute(sql)
+        cols = [f.name for f in fields(model)]
+        conn.executemany('insert into %s (%s) values (%s)' % (_q(model.__table__), ','.join(_q(c) for c in cols), ','.join(['?'] * len(cols))), _rows(model, rows))
+    conn.commit()
+    conn.execute('analyze')
+    return conn
+
+def _plan(conn, sql, args):
+    return '; '.join(r[-1] for r in conn.execute('explain query plan ' + sql, args))
+
+def _timing(conn, sql, args, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        conn.execute(sql, args).fetchall()
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+def _standin_indexes(conn, table):
+    L = []
+    for r in conn.execute('pragma index_list(%s)' % _q(table)):
+        cols = tuple(c[2] for c in conn.execute('pragma index_info(%s)' % _q(r[1])))
+        L.append(cols)
+    return L
+
+def advise(models, queries, conn=None, rows=10000):
+    """
+    根据记录的查询推荐缺少的索引，queries为QueryRecorder.queries()的结果
+    conn为sqlite替身库的连接，为None时用create_standin()创建
+    返回按估计节省的总耗时排序的建议，每项为Dict(table, columns, sql, calls, plan_before, plan_after, before, after, saving)
+    """
+    tables = dict((m.__table__, m) for m in models)
+    candidates = {}
+    for key, calls, elapsed, sql, args in queries:
+        parsed = parse_query(sql)
+        if not parsed or parsed[0] not in tables:
+            continue
+        table, eq, ranges, orders = parsed
+        model = tables[table]
+        pk = model.__primary_key__.name
+        cols = _candidate(eq, ranges, orders)
+        if not cols or cols[0] == pk or any(c not in model.__mappings__ for c in cols):
+            continue
+        c = candidates.setdefault((table, cols), dict(eq=len(eq), queries=[]))
+        c['queries'].append((calls, sql, args))
+    # 一个候选是另一个的前缀时合并到更长的复合索引
+    for key in sorted(candidates, key=lambda x: len(x[1])):
+        table, cols = key
+        for t2, cols2 in candidates.keys():
+            if t2 == table and len(cols2) > len(cols) and _serves(cols2, cols, candidates[key]['eq']):
+                candidates[(t2, cols2)]['queries'].extend(candidates.pop(key)['queries'])
+                break
+    if conn is None:
+        conn = create_standin(models, rows=rows)
+    L = []
+    for (table, cols), c in candidates.iteritems():
+        if any(_serves(index, cols, c['eq']) for index in _standin_indexes(conn, table)):
+            continue
+        name = '%s_advise_%s' % (table, '_'.join(cols))
+        before, after, plan_before, plan_after = {}, {}, {}, {}
+        for calls, sql, args in c['queries']:
+            plan_before[sql] = _plan(conn, sql, args)
+            before[sql] = _timing(conn, sql, args)
+        conn.execute('create index %s on %s (%s)' % (_q(name), _q(table), ','.join(_q(col) for col in cols)))
+        try:
+            for calls, sql, args in c['queries']:
+                plan_after[sql] = _plan(conn, sql, args)
+                after[sql] = _timing(conn, sql, args)
+        finally:
+            conn.execute('drop index %s' % _q(name))
+        calls, sql, args = max(c['queries'])
+        L.append(db.Dict(table=table, columns=cols,
+                         sql=_add_index(table, 'idx_' + '_'.join(cols), cols, False, 'mysql'),
+                         calls=sum(q[0] for q in c['queries']),
+                         query=sql, plan_before=plan_before[sql], plan_after=plan_after[sql],
+                         before=before[sql], after=after[sql],
+                         saving=sum(q[0] * (before[q[1]] - after[q[1]]) for q in c['queries'])))
+    L.sort(key=lambda x: x.saving, reverse=True)
+    return L
@@ -0,0 +1,440 @@
+# search.py
+# -*- encoding: utf-8 -*-
+
+"""
+进程内全文索引
+    倒排表保存在array中，每个词对应一组递增的文档编号和词频
+    英文按单词切分，中日韩文字同时索引单字和相邻两字，无需分词词典
+    查询按BM25排序，以*结尾的词做前缀匹配
+    索引通过ORM的insert/update/delete增量更新，可保存到文件，启动时用mmap加载
+    open()之后本进程通过ORM修改的文档记录在日志文件（索引文件名加.log）中，
+    加载时重新读取保存之后修改的文档，再与数据库的行数和最大主键比较，不一致时重建
+"""
+
+import os
+import re
+import math
+import time
+import mmap
+import heapq
+import bisect
+import struct
+import marshal
+import logging
+import threading
+from array import array
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from transwarp import db, orm
+
+_MAGIC = 'TWIX'
+_VERSION = 2
+# 保存时其他进程的修改可能还没有通知到，加载时多重读这么多秒的日志
+_JOURNAL_MARGIN = 60
+
+# 重建时整体替换的属性，与_reset()中的一致
+_STATE = ('_keys', '_docnos', '_lengths', '_deleted', '_total_length', '_postings', '_mapped', '_sorted_terms', '_mmap')
+_HEADER = struct.Struct('<4sIQ')
+
+_RE_WORD = re.compile(u'[0-9a-z\u00c0-\u024f]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+')
+_RE_CJK = re.compile(u'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]')
+
+def _to_unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8', 'ignore')
+    return s or u''
+
+def tokenize(text):
+    """
+    返回文本中的词，中日韩文字返回单字和相邻两字
+    """
+    L = []
+    for w in _RE_WORD.findall(_to_unicode(text).lower()):
+        if _RE_CJK.match(w):
+            L.extend(w)
+            L.extend(w[i:i+2] for i in xrange(len(w) - 1))
+        else:
+            L.append(w)
+    return L
+
+def _query_terms(text):
+    """
+    查询中的词：中日韩文字用相邻两字（单个字时用单字），保留末尾的*
+    """
+    L = []
+    for part in _to_unicode(text).lower().split():
+        prefix = part.endswith('*')
+        for w in _RE_WORD.findall(part):
+            if _RE_CJK.match(w):
+                L.extend([w] if len(w) == 1 else [w[i:i+2] for i in xrange(len(w) - 1)])
+            else:
+                L.append(w + '*' if prefix else w)
+    return L
+
+class SearchIndex(object):
+    """
+    model为被索引的Model类，fields为被索引的字段，weights为各字段的权重
+    listen为False时不注册ORM监听函数，用于重建时的临时索引
+    """
+    def __init__(self, model, fields, weights=None, k1=1.2, b=0.75, listen=True):
+        self.model = model
+        self.fields = tuple(fields)
+        self.weights = weights or {}
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self.path = None
+        # 重建期间修改的文档，重建完成后重新读取；不在重建时为None
+        self._changed = None
+        self._rebuilding = False
+        self._rebuild_again = False
+        self._reset()
+        if listen:
+            orm.add_model_listener(self._on_model_change)
+
+    def _reset(self):
+        self._keys = []
+        self._docnos = {}
+        self._lengths = array('I')
+        self._deleted = set()
+        self._total_length = 0
+        self._postings = {}
+        self._mapped = {}
+        self._sorted_terms = None
+        self._mmap = None
+
+    def __len__(self):
+        return len(self._docnos)
+
+    def _posting(self, term):
+        """
+        返回词的倒排表(docnos, tfs)，尚在mmap中的先解码
+        """
+        p = self._postings.get(term)
+        if p is None:
+            loc = self._mapped.pop(term, None)
+            if loc is None:
+                return None
+            offset, n = loc
+            docnos = array('I')
+            docnos.fromstring(self._mmap[offset:offset + 4 * n])
+            tfs = array('I')
+            tfs.fromstring(self._mmap[offset + 4 * n:offset + 8 * n])
+            p = self._postings[term] = (docnos, tfs)
+        return p
+
+    def _terms(self):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(set(self._postings) | set(self._mapped))
+        return self._sorted_terms
+
+    def add(self, key, doc):
+        """
+        索引文档，key已存在时替换
+        """
+        tfs = {}
+        for field in self.fields:
+            weight = self.weights.get(field, 1)
+            # Model.get()是按主键查询，这里要用dict.get()
+            for term in tokenize(dict.get(doc, field)):
+                tfs[term] = tfs.get(term, 0) + weight
+        with self._lock:
+            if self._changed is not None:
+                self._changed.add(key)
+            self._remove(key)
+            docno = len(self._keys)
+            self._keys.append(key)
+            self._docnos[key] = docno
+            length = sum(tfs.itervalues())
+            self._lengths.append(length)
+            self._total_length += length
+            for term, tf in tfs.iteritems():
+                p = self._posting(term)
+                if p is None:
+                    p = self._postings[term] = (array('I'), array('I'))
+                    self._sorted_terms = None
+                p[0].append(docno)
+                p[1].append(tf)
+
+    def remove(self, key):
+        with self._lock:
+            if self._changed is not None:
+                self._changed.add(key)
+            self._remove(key)
+
+    def _remove(self, key):
+        docno = self._docnos.pop(key, None)
+        if docno is not None:
+            self._deleted.add(docno)
+            self._total_length -= self._lengths[docno]
+            # 被删除的文档太多时重建，回收倒排表空间
+            if len(self._deleted) > 1000 and len(self._deleted) > len(self._docnos):
+                self.compact()
+
+    def _on_model_change(self, action, model):
+        if isinstance(model, self.model):
+            key = getattr(model, self.model.__primary_key__.name)
+            if action == 'delete':
+                self.remove(key)
+            else:
+                self.add(key, model)
+            self._log(key)
+
+    def _log(self, key):
+        # 一行不超过PIPE_BUF的追加写是原子的，多个进程可以同时写
+        if self.path:
+            with open(self.path + '.log', 'a') as f:
+                f.write(json.dumps([time.time(), key]) + '\n')
+
+    def on_change(self, table, pk):
+        """
+        InvalidationBus的订阅函数，从数据库重新读取其他进程修改的文档
+        整个表的事件和消息丢失时的(None, None)无法确定修改了哪些文档，在后台重建索引
+        """
+        if table is None or (table == self.model.__table__ and pk is None):
+            self.rebuild_async()
+        elif table == self.model.__table__:
+            self.refresh(pk)
+
+    def rebuild_async(self):
+        """
+        在后台线程中重建索引，已经在重建时合并为重建完成后再重建一次
+        """
+        with self._lock:
+            if self._rebuilding:
+                self._rebuild_again = True
+                return
+            self._rebuilding = True
+        t = threading.Thread(target=self._rebuild_loop, name='search-rebuild')
+        t.daemon = True
+        t.start()
+
+    def _rebuild_loop(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception:
+                logging.exception('failed to rebuild search index')
+            with self._lock:
+                if not self._rebuild_again:
+                    self._rebuilding = False
+                    return
+                self._rebuild_again = False
+
+    def refresh(self, key):
+        """
+        从数据库重新读取文档，已删除时从索引中去掉
+        """
+        pk = self.model.__primary_key__.name
+        d = db.select_one('select %s from %s where %s=?' % (','.join((pk, ) + self.fields), self.model.__table__, pk), key)
+        if d is None:
+            self.remove(key)
+        else:
+            self.add(key, d)
+
+    def search(self, query, limit=20):
+        """
+        返回按BM25得分排序的[(key, score)]
+        """
+        terms = _query_terms(query)
+        with self._lock:
+            n = len(self._docnos)
+            if not terms or not n:
+                return []
+            avgdl = float(self._total_length) / n
+            scores = {}
+            for term in terms:
+                if term.endswith('*'):
+                    expanded = self._expand(term[:-1])
+                else:
+                    expanded = [term]
+                for t in expanded:
+                    p = self._posting(t)
+                    if p is None:
+                        continue
+                    # 倒排表中还有已删除或被替换的文档，df只计算存在的文档，否则df可能大于n，idf为负
+                    live = [(docno, tf) for docno, tf in zip(*p) if docno not in self._deleted]
+                    if not live:
+                        continue
+                    df = len(live)
+                    idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                    for docno, tf in live:
+                        norm = self.k1 * (1 - self.b + self.b * self._lengths[docno] / avgdl)
+                        scores[docno] = scores.get(docno, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+            top = heapq.nlargest(limit, scores.iteritems(), key=lambda x: x[1])
+            return [(self._keys[docno], score) for docno, score in top]
+
+    def _expand(self, prefix, limit=50):
+        terms = self._terms()
+        i = bisect.bisect_left(terms, prefix)
+        L = []
+        while i < len(terms) and terms[i].startswith(prefix) and len(L) < limit:
+            L.append(terms[i])
+            i += 1
+        return L
+
+    def compact(self):
+        """
+        去掉已删除的文档，重新编号
+        """
+        with self._lock:
+            remap = {}
+            keys = []
+            lengths = array('I')
+            for docno, key in enumerate(self._keys):
+                if docno not in self._deleted:
+                    remap[docno] = len(keys)
+                    keys.append(key)
+                    lengths.append(self._lengths[docno])
+            postings = {}
+            for term in self._terms():
+                docnos, tfs = self._posting(term)
+                d, t = array('I'), array('I')
+                for docno, tf in zip(docnos, tfs):
+                    if docno in remap:
+                        d.append(remap[docno])
+                        t.append(tf)
+                if d:
+                    postings[term] = (d, t)
+            self._keys = keys
+            self._docnos = dict((k, i) for i, k in enumerate(keys))
+            self._lengths = lengths
+            self._deleted = set()
+            self._postings = postings
+            self._mapped = {}
+            self._sorted_terms = None
+
+    def rebuild(self, batch=500):
+        """
+        从数据库重新建立索引
+        在临时索引中建立，完成后整体替换，期间查询使用旧的索引；期间修改的文档在替换后重新读取
+        """
+        pk = self.model.__primary_key__.name
+        columns = ','.join((pk,) + self.fields)
+        with self._lock:
+            if self._changed is None:
+                self._changed = set()
+        index = SearchIndex(self.model, self.fields, self.weights, self.k1, self.b, listen=False)
+        try:
+            last = ''
+            while True:
+                L = db.select('select %s from %s where %s>? order by %s limit %d' % (columns, self.model.__table__, pk, pk, batch), last)
+                for d in L:
+                    index.add(d[pk], d)
+                if len(L) < batch:
+                    break
+                last = L[-1][pk]
+        finally:
+            with self._lock:
+                changed, self._changed = self._changed, None
+        with self._lock:
+            for name in _STATE:
+                setattr(self, name, getattr(index, name))
+        for key in changed:
+            self.refresh(key)
+
+    def save(self, path=None):
+        """
+        保存到文件：头部、marshal格式的元数据、每个词的docnos和tfs数组
+        保存后日志文件改名为.log.old，加载时两个日志文件都会读取
+        """
+        path = path or self.path
+        with self._lock:
+            saved_at = time.time()
+            self.compact()
+            terms = {}
+            chunks = []
+            offset = 0
+            for term in self._terms():
+                docnos, tfs = self._postings[term]
+                terms[term] = (offset, len(docnos))
+                chunks.append(docnos.tostring())
+                chunks.append(tfs.tostring())
+                offset += 8 * len(docnos)
+            meta = marshal.dumps((self.fields, saved_at, self._keys, self._lengths.tostring(), terms))
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, len(meta)))
+            f.write(meta)
+            for c in chunks:
+                f.write(c)
+        os.rename(tmp, path)
+        if os.path.isfile(path + '.log'):
+            os.rename(path + '.log', path + '.log.old')
+
+    def load(self, path):
+        """
+        从文件加载，倒排表留在mmap中，查询时才解码，返回保存的时间
+        """
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_len = _HEADER.unpack(m[:_HEADER.size])
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('Invalid index file: %s' % path)
+        fields, saved_at, keys, lengths, terms = marshal.loads(m[_HEADER.size:_HEADER.size + meta_len])
+        if tuple(fields) != self.fields:
+            raise ValueError('Index file %s has different fields.' % path)
+        base = _HEADER.size + meta_len
+        with self._lock:
+            self._reset()
+            self._mmap = m
+            self._keys = keys
+            self._docnos = dict((k, i) for i, k in enumerate(keys))
+            self._lengths = array('I')
+            self._lengths.fromstring(lengths)
+            self._total_length = sum(self._lengths)
+            self._mapped = dict((t, (base + offset, n)) for t, (offset, n) in terms.iteritems())
+        return saved_at
+
+    def _replay(self, path, since):
+        """
+        重新读取日志中since之后修改的文档
+        """
+        keys = set()
+        for name in (path + '.log.old', path + '.log'):
+            if not os.path.isfile(name):
+                continue
+            with open(name) as f:
+                for line in f:
+                    try:
+                        t, key = json.loads(line)
+                    except ValueError:
+                        # 进程退出时只写了一半的行
+                        continue
+                    if t >= since:
+                        keys.add(key)
+        for key in keys:
+            self.refresh(key)
+        return len(keys)
+
+    def _up_to_date(self):
+        """
+        与数据库的行数和最大主键比较，发现不通过本模块的写入
+        """
+        pk = self.model.__primary_key__.name
+        d = db.select_one('select count(%s) as n, max(%s) as last from %s' % (pk, pk, self.model.__table__))
+        with self._lock:
+            return d.n == len(self._docnos) and d.last == (max(self._docnos) if self._docnos else None)
+
+    def open(self, path):
+        """
+        有索引文件时加载并补上保存之后的修改，否则从数据库建立并保存
+        之后用save()定期保存，不带参数时保存到path
+        """
+        self.path = path
+        if os.path.isfile(path):
+            try:
+                saved_at = self.load(path)
+                n = self._replay(path, saved_at - _JOURNAL_MARGIN)
+                if self._up_to_date():
+                    logging.info('search index loaded, %d documents refreshed from journal' % n)
+                    return
+                logging.warning('Index file %s is out of date, rebuilding' % path)
+            except ValueError, e:
+                logging.warning('%s, rebuilding' % e)
+        self.rebuild()
+        self.save(path)
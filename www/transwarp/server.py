@@ -0,0 +1,365 @@
+# server.py
+# -*- encoding: utf-8 -*-
+
+"""
+生产环境WSGI服务器：prefork多进程 + 每个进程内的线程池
+master进程只负责管理worker：
+    SIGHUP          平滑重启所有worker
+    SIGTERM/SIGINT  平滑关闭
+worker处理max_requests个请求后通知master，master先fork一个替代的worker，
+替代的worker开始监听后才让旧的worker退出，回收期间始终有worker在accept，以控制内存增长
+worker通过管道向master报告状态：ready（已开始监听）、retire（请求数已达上限）
+
+worker_class:
+    sync    每个worker一个线程池，并发数受threads限制
+    gevent  每个worker一个gevent协程池，并发数受connections限制，
+            慢的数据库调用只占用一个协程而不是一个线程。
+            要求在导入transwarp之前执行gevent.monkey.patch_all()，
+            这样ctx和数据库连接所在的threading.local才会变成greenlet local；
+            数据库驱动也必须是纯python的（如create_engine(driver='pymysql')），
+            MySQLdb是C扩展，会阻塞整个进程
+"""
+
+import os
+import sys
+import time
+import errno
+import random
+import select
+import signal
+import socket
+import logging
+import threading
+import Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from transwarp import db
+
+_SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+
+class _RequestHandler(WSGIRequestHandler):
+    """
+    访问日志走logging，而不是直接写stderr
+    """
+    def log_message(self, format, *args):
+        logging.debug('%s - %s' % (self.client_address[0], format % args))
+
+# 线程池已满时直接返回的响应
+_REJECTED_BODY = '<html><body><h1>503 Service Unavailable</h1></body></html>'
+_REJECTED = 'HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Type: text/html; charset=utf-8\r\n' \
+            'Content-Length: %d\r\nConnection: close\r\n\r\n%s' % (len(_REJECTED_BODY), _REJECTED_BODY)
+
+class _PooledWSGIServer(WSGIServer):
+    """
+    accept在主线程，请求交给固定大小的线程池处理
+    同时处理的请求不超过threads个，其余最多threads*4个在队列中等待，
+    队列满时在accept循环中直接返回503，不再阻塞accept
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, app, threads=8, reuse_port=False, sock=None):
+        self._reuse_port = reuse_port
+        WSGIServer.__init__(self, address, _RequestHandler, bind_and_activate=sock is None)
+        if sock is not None:
+            # 使用master进程中已经listen的socket
+            self.socket.close()
+            self.socket = sock
+            host, port = sock.getsockname()[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+            self.setup_environ()
+        self.set_app(app)
+        self.handled = 0
+        self.rejected = 0
+        self._queue = Queue.Queue(threads * 4)
+        self._threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._work, name='worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def server_bind(self):
+        if self._reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        WSGIServer.server_bind(self)
+
+    def process_request(self, request, client_address):
+        self.handled = self.handled + 1
+        try:
+            self._queue.put_nowait((request, client_address))
+        except Queue.Full:
+            self.rejected = self.rejected + 1
+            try:
+                request.sendall(_REJECTED)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def drain(self):
+        """
+        停止线程池，等待已接收的请求处理完
+        """
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+class PreforkServer(object):
+    """
+    prefork服务器，workers为进程数，threads为每个进程的线程数
+    after_fork为fork后在worker中依次调用的函数，默认重建数据库引擎
+    max_requests_jitter默认为max_requests的十分之一（至少为1），避免所有worker同时回收
+    reuse_port为True时每个worker用SO_REUSEPORT各自监听，由内核分配连接；
+    旧的worker关闭监听时其backlog中未accept的连接会被重置，对此敏感时设为False，改为共享master的socket
+    """
+    def __init__(self, app, host='127.0.0.1', port=9000, workers=2, threads=8, worker_class='sync', connections=1000,
+                 max_requests=0, max_requests_jitter=None, graceful_timeout=30, reuse_port=True, after_fork=None):
+        if worker_class not in ('sync', 'gevent'):
+            raise ValueError('Invalid worker class: %s' % worker_class)
+        self.app = app
+        self.address = (host, port)
+        self.workers = workers
+        self.threads = threads
+        self.worker_class = worker_class
+        self.connections = connections
+        self.max_requests = max_requests
+        if max_requests_jitter is None:
+            max_requests_jitter = max(1, max_requests // 10) if max_requests else 0
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.after_fork = [db.reinit_after_fork] if after_fork is None else list(after_fork)
+        self.reuse_port = reuse_port and _SO_REUSEPORT is not None
+        self._sock = None
+        self._children = {}
+        # 已请求退出、等待替代worker就绪的旧worker，以及替代worker到旧worker的映射
+        self._retiring = {}
+        self._replacing = {}
+        self._pipe = None
+        self._buffer = ''
+        self._signals = []
+
+    def _listen(self, reuse_port=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        sock.listen(_PooledWSGIServer.request_queue_size)
+        return sock
+
+    def run(self):
+        if self.worker_class == 'gevent':
+            from gevent import monkey
+            if not monkey.is_module_patched('thread'):
+                raise RuntimeError('gevent worker requires gevent.monkey.patch_all() before importing transwarp.')
+        if not self.reuse_port:
+            # 不支持SO_REUSEPORT时由master监听，worker共享同一个socket
+            self._sock = self._listen()
+        # master启动时用过的数据库连接（如建立全文索引）不能被worker继承
+        db.close_pool()
+        self._pipe = os.pipe()
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, lambda signum, frame: self._signals.append(signum))
+        logging.info('master %d listening on %s:%d, %d workers x %d threads' % ((os.getpid(),) + self.address + (self.workers, self.threads)))
+        self._manage()
+
+    def _manage(self):
+        self._spawn_missing()
+        while True:
+            while self._signals:
+                sig = self._signals.pop(0)
+                if sig == signal.SIGHUP:
+                    self._reload()
+                else:
+                    self._shutdown()
+                    return
+            self._reap()
+            self._spawn_missing()
+            self._poll(0.5)
+
+    def _spawn_missing(self):
+        while len(self._children) < self.workers:
+            self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.time()
+            return pid
+        os.close(self._pipe[0])
+        try:
+            code = self._worker()
+        except Exception:
+            logging.exception('worker %d crashed' % os.getpid())
+            code = 1
+        os._exit(code)
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    self._children.clear()
+                    return
+                raise
+            if not pid:
+                return
+            if self._children.pop(pid, None) is not None or self._retiring.pop(pid, None) is not None:
+                logging.info('worker %d exited with status %d' % (pid, status))
+            old = self._replacing.pop(pid, None)
+            if old is not None:
+                # 替代的worker没有就绪就退出了，让旧的worker也退出，由_spawn_missing补齐
+                self._kill(old, signal.SIGTERM)
+
+    def _poll(self, timeout):
+        """
+        等待timeout秒，处理期间worker发来的消息
+        """
+        try:
+            readable = select.select([self._pipe[0]], [], [], timeout)[0]
+        except select.error, e:
+            # 被信号中断
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if not readable:
+            return
+        self._buffer = self._buffer + os.read(self._pipe[0], 4096)
+        lines = self._buffer.split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            kind, pid = line.split(' ')
+            pid = int(pid)
+            if kind == 'retire' and pid in self._children:
+                self._retiring[pid] = self._children.pop(pid)
+                self._replacing[self._spawn()] = pid
+            elif kind == 'ready':
+                old = self._replacing.pop(pid, None)
+                if old is not None:
+                    self._kill(old, signal.SIGTERM)
+
+    def _notify(self, kind):
+        # 不超过PIPE_BUF的write是原子的，多个worker同时写不会交错
+        os.write(self._pipe[1], '%s %d\n' % (kind, os.getpid()))
+
+    def _reload(self):
+        """
+        先启动新的worker，每个新的worker开始监听后，再让一个旧的worker处理完手头的请求后退出
+        """
+        logging.info('reloading workers')
+        old = self._children.keys() + self._retiring.keys()
+        self._retiring.update(self._children)
+        self._children = {}
+        for pid in old:
+            self._replacing[self._spawn()] = pid
+        self._wait(old)
+
+    def _shutdown(self):
+        logging.info('shutting down')
+        pids = self._children.keys() + self._retiring.keys()
+        for pid in pids:
+            self._kill(pid, signal.SIGTERM)
+        self._wait(pids)
+        self._children.clear()
+        self._retiring.clear()
+        self._replacing.clear()
+        if self._sock is not None:
+            self._sock.close()
+
+    def _wait(self, pids):
+        deadline = time.time() + self.graceful_timeout
+        pids = set(pids)
+        while pids:
+            for pid in list(pids):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        pids.discard(pid)
+                        self._retiring.pop(pid, None)
+                except OSError:
+                    pids.discard(pid)
+                    self._retiring.pop(pid, None)
+            if time.time() > deadline:
+                for pid in pids:
+                    self._kill(pid, signal.SIGKILL)
+                deadline = time.time() + self.graceful_timeout
+            self._poll(0.1)
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _worker(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for fn in self.after_fork:
+            fn()
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            # 避免所有worker同时回收
+            max_requests = max_requests + random.randint(0, self.max_requests_jitter)
+        logging.info('worker %d started' % os.getpid())
+        if self.worker_class == 'gevent':
+            return self._gevent_worker(max_requests)
+        return self._sync_worker(max_requests)
+
+    def _sync_worker(self, max_requests):
+        state = dict(alive=True)
+        def _stop(signum, frame):
+            state['alive'] = False
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGHUP, _stop)
+        server = _PooledWSGIServer(self.address, self.app, self.threads, self.reuse_port, self._sock)
+        server.timeout = 1.0
+        self._notify('ready')
+        retired = False
+        # 达到max_requests后继续处理请求，直到替代的worker就绪、master发来SIGTERM
+        while state['alive']:
+            server.handle_request()
+            if max_requests and server.handled >= max_requests and not retired:
+                retired = True
+                self._notify('retire')
+        server.socket.close()
+        server.drain()
+        sys.stdout.flush()
+        return 0
+
+    def _gevent_worker(self, max_requests):
+        import gevent
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer as GeventWSGIServer
+        sock = self._sock if self._sock is not None else self._listen(self.reuse_port)
+        handled = [0]
+        def _app(environ, start_response):
+            handled[0] = handled[0] + 1
+            if handled[0] == max_requests:
+                self._notify('retire')
+            return self.app(environ, start_response)
+        server = GeventWSGIServer(sock, _app, spawn=Pool(self.connections), log=None)
+        def _stop():
+            # 关闭监听并等待进行中的请求完成
+            server.stop(timeout=self.graceful_timeout)
+        signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+        for sig in (signal.SIGTERM, signal.SIGHUP):
+            signal_handler(sig, gevent.spawn, _stop)
+        server.start()
+        self._notify('ready')
+        server.serve_forever()
+        return 0
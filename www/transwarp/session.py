@@ -0,0 +1,116 @@
+# session.py
+# -*- encoding: utf-8 -*-
+
+"""
+基于签名Cookie的无状态session
+Cookie内容为'用户id-过期时间-签名'，签名为HMAC-SHA256，服务端不保存session
+解析出的用户对象缓存在进程内LRU中，通过ORM更新或删除该用户时失效
+"""
+
+import hmac
+import time
+import hashlib
+import logging
+
+from transwarp import orm
+from transwarp.cache import LRUCache
+from transwarp.web import ctx, interceptor
+
+# 缓存中表示用户不存在
+_NOT_FOUND = object()
+
+class SessionManager(object):
+    """
+    secret为签名密钥，model为用户的Model类
+    cache_size/cache_ttl为用户对象缓存的大小和过期秒数
+    """
+    def __init__(self, secret, model, cookie_name='session', max_age=86400, cache_size=1024, cache_ttl=30):
+        self.model = model
+        self.cookie_name = cookie_name
+        self.max_age = max_age
+        # 预先计算好密钥的HMAC对象，每次签名只需copy()
+        self._mac = hmac.new(secret, digestmod=hashlib.sha256)
+        self._cache = LRUCache(cache_size, cache_ttl)
+        orm.add_model_listener(self._on_model_change)
+
+    def _sign(self, payload):
+        mac = self._mac.copy()
+        mac.update(payload)
+        return mac.hexdigest()
+
+    def make_cookie(self, uid, max_age=None):
+        expires = int(time.time() + (self.max_age if max_age is None else max_age))
+        payload = '%s-%d' % (uid, expires)
+        return '%s-%s' % (payload, self._sign(payload))
+
+    def parse_cookie(self, value):
+        """
+        验证Cookie，返回其中的用户id，无效或过期时返回None
+        """
+        L = value.split('-') if value else []
+        if len(L) != 3:
+            return None
+        uid, expires, sig = L
+        if not expires.isdigit() or int(expires) < time.time():
+            return None
+        if not hmac.compare_digest(sig, self._sign('%s-%s' % (uid, expires))):
+            return None
+        return uid
+
+    def get_user(self, uid):
+        """
+        返回用户对象，优先从缓存中取
+        """
+        d = self._cache.get(uid)
+        if d is None:
+            user = self.model.get(uid)
+            self._cache.set(uid, _NOT_FOUND if user is None else dict(user))
+            return user
+        if d is _NOT_FOUND:
+            return None
+        # 缓存的是dict，每次返回新对象，避免请求之间互相修改
+        return self.model(**d)
+
+    def _on_model_change(self, action, model):
+        if isinstance(model, self.model):
+            self._cache.delete(getattr(model, model.__primary_key__.name))
+
+    def invalidate(self, uid):
+        self._cache.delete(uid)
+
+    def on_change(self, table, pk):
+        """
+        InvalidationBus的订阅函数，其他进程修改用户时清除缓存
+        """
+        if table is None or table == self.model.__table__:
+            if pk is None:
+                self._cache.clear()
+            else:
+                self._cache.delete(pk)
+
+    def login(self, user, max_age=None):
+        """
+        向当前响应写入session Cookie
+        """
+        max_age = self.max_age if max_age is None else max_age
+        uid = getattr(user, self.model.__primary_key__.name)
+        ctx.response.set_cookie(self.cookie_name, self.make_cookie(uid, max_age), max_age=max_age)
+
+    def logout(self):
+        ctx.response.delete_cookie(self.cookie_name)
+
+    def interceptor(self, pattern='/'):
+        """
+        返回拦截器，把当前用户绑定到ctx.request.user，未登录时为None
+        """
+        @interceptor(pattern)
+        def _session_interceptor(next):
+            request = ctx.request
+            request.user = None
+            uid = self.parse_cookie(request.cookie(self.cookie_name))
+            if uid:
+                request.user = self.get_user(uid)
+                if request.user is None:
+                    logging.info('session user %s not found' % uid)
+            return next()
+        return _session_interceptor
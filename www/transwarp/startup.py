@@ -0,0 +1,74 @@
+# startup.py
+# -*- encoding: utf-8 -*-
+
+"""
+启动耗时分析：各初始化阶段的耗时，以及每个模块的导入耗时
+    profiler = StartupProfiler()
+    profiler.install()          # 之后首次导入的模块都会计时
+    with profiler.phase('db'):
+        db.create_engine(...)
+    profiler.uninstall()
+    logging.info(profiler.report())
+"""
+
+import sys
+import time
+import __builtin__
+import contextlib
+
+class StartupProfiler(object):
+    """
+    导入耗时分为总耗时（包括它导入的其他模块）和自身耗时
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+        self.imports = {}
+        self._stack = []
+        self._import = None
+
+    def install(self):
+        if self._import is None:
+            self._import = __builtin__.__import__
+            __builtin__.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._import is not None:
+            __builtin__.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, *args, **kw):
+        # 已经导入的模块直接返回，只统计首次导入
+        if name in sys.modules:
+            return self._import(name, *args, **kw)
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kw)
+        finally:
+            elapsed = time.time() - start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if name in sys.modules:
+                self.imports[name] = (elapsed, elapsed - children)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+
+    def report(self, top=20):
+        """
+        返回文本格式的报告：各阶段耗时，以及自身耗时最多的top个模块
+        """
+        L = ['startup: %.1f ms' % ((time.time() - self.start) * 1000)]
+        for name, elapsed in self.phases:
+            L.append('  phase  %-24s %8.1f ms' % (name, elapsed * 1000))
+        items = sorted(self.imports.iteritems(), key=lambda x: x[1][1], reverse=True)
+        for name, (total, own) in items[:top]:
+            L.append('  import %-24s %8.1f ms (self %.1f ms)' % (name, total * 1000, own * 1000))
+        return '\n'.join(L)
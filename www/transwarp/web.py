@@ -3,18 +3,67 @@
 
 import threading
 import functools
+import itertools
+import logging
 import types
+import time
+import collections
 import re
+import urllib
+import urlparse
+import datetime
+import marshal
+import os
 from transwarp.db import Dict
 
-# 全局ThreadLocal对象：
+# JSON编码：优先使用更快的ujson/simplejson
+try:
+    import ujson as _json
+except ImportError:
+    try:
+        import simplejson as _json
+    except ImportError:
+        import json as _json
+
+# 全局ThreadLocal对象（gevent打补丁后为greenlet local）：
 ctx = threading.local()
 
+# HTTP状态码
+_RESPONSE_STATUSES = {
+    200: 'OK',
+    301: 'Moved Permanently',
+    302: 'Found',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
 # HTTP错误类
 class HttpError(Exception):
-    pass
+    def __init__(self, code, headers=None):
+        super(HttpError, self).__init__()
+        self.status = '%d %s' % (code, _RESPONSE_STATUSES.get(code, ''))
+        self.headers = headers or []
+
+    def __str__(self):
+        return self.status
+
+    __repr__ = __str__
 
+def notfound():
+    return HttpError(404)
 
+def _decode_input(s):
+    # 参数不是合法的utf-8时是客户端的错误
+    try:
+        return s.decode('utf-8')
+    except UnicodeDecodeError:
+        raise HttpError(400)
 
 class Request(object):
     """
@@ -23,46 +72,141 @@ class Request(object):
 
     def __init__(self, environ):
         self._environ = environ
+        self.route = None
+        self.timings = {}
+        self._on_close = []
+
+    def _get_raw_input(self):
+        if not hasattr(self, '_raw_input'):
+            d = urlparse.parse_qs(self._environ.get('QUERY_STRING', ''), keep_blank_values=True)
+            if self.request_method == 'POST' and self._environ.get('CONTENT_TYPE', '').startswith('application/x-www-form-urlencoded'):
+                length = int(self._environ.get('CONTENT_LENGTH') or 0)
+                body = self._environ['wsgi.input'].read(length) if length else ''
+                for k, v in urlparse.parse_qs(body, keep_blank_values=True).iteritems():
+                    d.setdefault(k, []).extend(v)
+            self._raw_input = d
+        return self._raw_input
 
     # 根据key返回value：
     def get(self, key, default=None):
-        pass
+        L = self._get_raw_input().get(key)
+        return _decode_input(L[0]) if L else default
 
     # 返回key-value的dict：
     def input(self):
-        pass
+        return Dict(**dict((k, _decode_input(v[0])) for k, v in self._get_raw_input().iteritems()))
+
+    @property
+    def environ(self):
+        return self._environ
+
+    @property
+    def request_method(self):
+        return self._environ['REQUEST_METHOD']
 
     # 返回URL的path：
     @property
     def path_info(self):
-        pass
+        return urllib.unquote(self._environ.get('PATH_INFO', ''))
 
     # 返回HTTP Headers：
     @property 
     def headers(self):
-        pass
+        if not hasattr(self, '_headers'):
+            self._headers = dict((k[5:].replace('_', '-').upper(), v.decode('utf-8', 'replace')) for k, v in self._environ.iteritems() if k.startswith('HTTP_'))
+        return self._headers
+
+    def header(self, name, default=None):
+        return self.headers.get(name.upper(), default)
+
+    def add_timing(self, phase, seconds):
+        """
+        累计请求各阶段耗时：routing/handler/db/template
+        """
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    # 返回所有Cookie的dict：
+    @property
+    def cookies(self):
+        if not hasattr(self, '_cookies'):
+            cookies = {}
+            for c in self._environ.get('HTTP_COOKIE', '').split(';'):
+                pos = c.find('=')
+                if pos > 0:
+                    cookies[c[:pos].strip()] = urllib.unquote(c[pos+1:].strip())
+            self._cookies = cookies
+        return self._cookies
 
     # 根据key返回Cookie value：
     def cookie(self, name, default=None):
-        pass
+        return self.cookies.get(name, default)
 
 # response对象：
 class Response(object):
+    def __init__(self):
+        self._status = '200 OK'
+        self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
+        self._cookies = None
+
+    # 返回WSGI需要的header列表：
+    @property
+    def headers(self):
+        L = [(k.title(), v) for k, v in self._headers.iteritems()]
+        if self._cookies:
+            L.extend(('Set-Cookie', v) for v in self._cookies.itervalues())
+        return L
+
+    def header(self, name):
+        return self._headers.get(name.upper())
+
     # 设置header：
     def set_header(self, key, value):
-        pass
+        self._headers[key.upper()] = str(value)
 
-    # 设置Cookie：
-    def set_cookie(self, name, value, max_age=None, expires=None, path='/'):
-        pass
+    @property
+    def content_type(self):
+        return self.header('CONTENT-TYPE')
+    @content_type.setter
+    def content_type(self, value):
+        self.set_header('CONTENT-TYPE', value)
+
+    # 设置Cookie，expires为时间戳或datetime：
+    def set_cookie(self, name, value, max_age=None, expires=None, path='/', domain=None, secure=False, http_only=True):
+        if self._cookies is None:
+            self._cookies = {}
+        L = ['%s=%s' % (name, urllib.quote(value))]
+        if expires is not None:
+            if isinstance(expires, (int, long, float)):
+                expires = datetime.datetime.utcfromtimestamp(expires)
+            L.append('Expires=%s' % expires.strftime('%a, %d-%b-%Y %H:%M:%S GMT'))
+        if max_age is not None:
+            L.append('Max-Age=%d' % max_age)
+        L.append('Path=%s' % path)
+        if domain:
+            L.append('Domain=%s' % domain)
+        if secure:
+            L.append('Secure')
+        if http_only:
+            L.append('HttpOnly')
+        self._cookies[name] = '; '.join(L)
+
+    # 删除Cookie：
+    def delete_cookie(self, name, path='/'):
+        self.set_cookie(name, '__deleted__', expires=0, path=path)
+
+    # 设置status，可以是int或'404 Not Found'形式的字符串：
+    @property
+    def status_code(self):
+        return int(self._status[:3])
 
-    # 设置status：
     @property
     def status(self):
-        pass
+        return self._status
     @status.setter
     def status(self, value):
-        pass
+        if isinstance(value, (int, long)):
+            value = '%d %s' % (value, _RESPONSE_STATUSES.get(value, ''))
+        self._status = str(value)
 
 ###################################
 #   URL路由， 将URL 映射到函数上
@@ -98,7 +242,7 @@ def _build_regex(path):
         if is_var:
             var_name = v[1:]
             var_list.append(var_name)
-            re_list.append(r'(?p<%s>[^\/]+)' % var_name)
+            re_list.append(r'(?P<%s>[^\/]+)' % var_name)
         else:
             s = ''
             for ch in v:
@@ -124,7 +268,7 @@ class Route(object):
         self.method = func.__web_method__
         self.is_static = _re_route.search(self.path) is None
         if not self.is_static:
-            self.route = re.compile(_build)
+            self.route = re.compile(_build_regex(self.path))
         self.func = func
 
     def match(self, url):
@@ -163,23 +307,227 @@ class Template(object):
         self.template_name = template_name
         self.model = dict(**kw)
 
+#################################
+#   JSON API
+#################################
+
+# 列表分块输出时每块的元素数
+_API_CHUNK_SIZE = 100
+
+class APIError(StandardError):
+    """
+    API错误，返回的json为{"error": error, "data": data, "message": message}
+    """
+    status = 400
+
+    def __init__(self, error, data='', message=''):
+        super(APIError, self).__init__(message)
+        self.error = error
+        self.data = data
+        self.message = message
+
+class APIValueError(APIError):
+    """
+    参数错误，data为参数名
+    """
+    def __init__(self, field, message=''):
+        super(APIValueError, self).__init__('value:invalid', field, message)
+
+class APIResourceNotFoundError(APIError):
+    status = 404
+
+    def __init__(self, field, message=''):
+        super(APIResourceNotFoundError, self).__init__('value:notfound', field, message)
+
+class APIPermissionError(APIError):
+    status = 403
+
+    def __init__(self, message=''):
+        super(APIPermissionError, self).__init__('permission:forbidden', 'permission', message)
+
+def _to_json_obj(obj):
+    """
+    Model只输出__json_fields__中的字段，其余原样返回
+    """
+    fields = getattr(obj, '__json_fields__', None)
+    if fields is not None:
+        return dict((k, dict.get(obj, k)) for k in fields)
+    if isinstance(obj, (list, tuple)):
+        return [_to_json_obj(x) for x in obj]
+    if isinstance(obj, dict):
+        return dict((k, _to_json_obj(v)) for k, v in obj.iteritems())
+    return obj
+
+def _dumps(obj):
+    return _json.dumps(_to_json_obj(obj))
+
+def _dumps_iter(items, name='api'):
+    """
+    把列表或生成器分块编码成json数组，不用一次生成整个字符串
+    """
+    yield '['
+    chunk = []
+    first = True
+    try:
+        for item in items:
+            chunk.append(_dumps(item))
+            if len(chunk) >= _API_CHUNK_SIZE:
+                yield (',' if not first else '') + ','.join(chunk)
+                first = False
+                chunk = []
+    except Exception:
+        logging.exception('Error while streaming api %s, response truncated' % name)
+        raise
+    if chunk:
+        yield (',' if not first else '') + ','.join(chunk)
+    yield ']'
+
+def _is_stream(r):
+    """
+    生成器等迭代器在wsgi()返回后才由WSGI服务器执行
+    """
+    return isinstance(r, collections.Iterator)
+
+class _ClosingIterator(object):
+    """
+    流式输出的响应体，WSGI服务器输出完调用close()时才结束请求（PEP 3333）：
+    释放并发限制、记录监控指标、清除ctx
+    迭代时重新设置ctx，生成器中仍然可以使用ctx.request/ctx.response
+    """
+    def __init__(self, iterable, application, request, response, finish):
+        self._iterable = iterable
+        self._application = application
+        self._request = request
+        self._response = response
+        self._finish = finish
+        self._closed = False
+
+    def __iter__(self):
+        ctx.application = self._application
+        ctx.request = self._request
+        ctx.response = self._response
+        try:
+            for chunk in self._iterable:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                yield chunk
+        except Exception:
+            # 状态和头部已经发出，只能中断输出，监控和并发限制按失败的请求记录
+            self._response.status = 500
+            logging.exception('Error while streaming %s %s' % (self._request.request_method, self._request.path_info))
+            raise
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self._iterable, 'close', None)
+            if close:
+                close()
+        finally:
+            self._finish()
+
+def _api_error(status, error, data='', message=''):
+    ctx.response.status = status
+    return _dumps(dict(error=error, data=data, message=message))
+
+def _http_error_json(e):
+    """
+    HttpError对应的json，error为http:状态码，message为状态
+    """
+    return _dumps(dict(error='http:%s' % e.status[:3], data='', message=e.status))
+
+def _prefetch(gen):
+    """
+    先取出生成器的第一个元素，查询出错时可以在输出之前返回错误
+    """
+    try:
+        first = next(gen)
+    except StopIteration:
+        return []
+    return itertools.chain([first], gen)
+
+def api(func):
+    """
+    把返回值编码为json，列表和生成器分块输出，APIError和HttpError转换为统一格式的错误
+    生成器在返回前先取第一个元素；之后再出错时状态和头部已经发出，只能记录日志并中断输出，
+    客户端收到的是不完整（无法解析）的json，而不是看起来正常的短数组
+    """
+    @functools.wraps(func)
+    def _wrapper(*args, **kw):
+        ctx.response.content_type = 'application/json; charset=utf-8'
+        try:
+            r = func(*args, **kw)
+            if isinstance(r, types.GeneratorType):
+                r = _dumps_iter(_prefetch(r), func.__name__)
+        except APIError, e:
+            return _api_error(e.status, e.error, e.data, e.message)
+        except HttpError, e:
+            ctx.response.status = e.status
+            for k, v in e.headers:
+                ctx.response.set_header(k, v)
+            return _http_error_json(e)
+        except Exception, e:
+            logging.exception('Error in api %s' % func.__name__)
+            return _api_error(500, 'internal:error', '', 'Internal Server Error')
+        if isinstance(r, list):
+            return _dumps_iter(r, func.__name__)
+        if isinstance(r, types.GeneratorType):
+            return r
+        return _dumps(r)
+    _wrapper.__api__ = True
+    return _wrapper
+
 # 定义模板引擎：
-def TemplateEngine(object):
+class TemplateEngine(object):
     def __call__(self, path, model):
         return '<!-- override this method to render template -->'
 
-def jinja2TemplateEngine(TemplateEngine):
+class jinja2TemplateEngine(TemplateEngine):
+    """
+    jinja2到第一次渲染时才导入并创建Environment，加快启动
+    """
     def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
         if 'autoescape' not in kw:
             kw['autoescape'] = True
-        self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+        self._templ_dir = templ_dir
+        self._kw = kw
+        self._filters = {}
+        self._env = None
+        self._lock = threading.Lock()
+
+    def _get_env(self):
+        if self._env is None:
+            with self._lock:
+                if self._env is None:
+                    from jinja2 import Environment, FileSystemLoader
+                    env = Environment(loader=FileSystemLoader(self._templ_dir), **self._kw)
+                    env.filters.update(self._filters)
+                    self._env = env
+        return self._env
 
     def add_filter(self, name, fn_filter):
-        self._env.filters[name] = fn_filter
+        self._filters[name] = fn_filter
+        if self._env is not None:
+            self._env.filters[name] = fn_filter
 
     def __call__(self, path, model):
-        return self._env.get_template(path).render(**model).encode('utf-8')
+        return self._get_env().get_template(path).render(**model).encode('utf-8')
+
+def _mtime(m):
+    """
+    模块源文件的修改时间
+    """
+    f = getattr(m, '__file__', None)
+    if not f:
+        return 0.0
+    if f.endswith(('.pyc', '.pyo')):
+        f = f[:-1]
+    try:
+        return os.path.getmtime(f)
+    except OSError:
+        return 0.0
 
 def _load_module(module_name):
     last_dot = module_name.rfind('.')
@@ -245,6 +593,11 @@ class WSGIApplication(object):
         self._document_root = document_root
         self._interceptors = []
         self._template_engine = None
+        self._metrics = None
+        self._limiter = None
+        self._registry = []
+        # 以此开头的路径和@api路由的HttpError（404/405/503等）以json返回，为None时不转换
+        self.api_prefix = '/api/'
 
         self._get_static = {}
         self._post_static = {}
@@ -263,13 +616,75 @@ class WSGIApplication(object):
         self._check_not_running()
         self._template_engine = engine
 
+    @property
+    def metrics(self):
+        return self._metrics
+    @metrics.setter
+    def metrics(self, metrics):
+        """
+        设置transwarp.metrics.Metrics，metrics.path不为空时同时注册指标输出的URL
+        """
+        self._check_not_running()
+        self._metrics = metrics
+        if metrics.path:
+            self.add_url(metrics.handler())
+
+    @property
+    def limiter(self):
+        return self._limiter
+    @limiter.setter
+    def limiter(self, limiter):
+        """
+        设置transwarp.limiter.AdmissionController，限制并发请求数
+        """
+        self._check_not_running()
+        self._limiter = limiter
+
     def add_module(self, mod):
         self._check_not_running()
         m = mod if type(mod) == types.ModuleType else _load_module(mod)
+        names = []
         for name in dir(m):
             fn = getattr(m, name)
             if callable(fn) and hasattr(fn, '__web_route__') and hasattr(fn, '__web_method__'):
                 self.add_url(fn)
+                names.append(name)
+        self._registry.append((m.__name__, _mtime(m), names))
+
+    def save_routes(self, path):
+        """
+        保存add_module()找到的路由，下次启动用load_routes()加载，不用再扫描模块
+        """
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            marshal.dump(self._registry, f)
+        os.rename(tmp, path)
+
+    def load_routes(self, path, *mods):
+        """
+        加载save_routes()保存的路由，效果与依次add_module(mods)相同
+        文件不存在、模块列表不同或模块文件已修改时返回False，需要重新add_module()
+        """
+        self._check_not_running()
+        try:
+            with open(path, 'rb') as f:
+                registry = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        mod_names = [m.__name__ if type(m) == types.ModuleType else m for m in mods]
+        if [r[0] for r in registry] != mod_names:
+            return False
+        loaded = []
+        for mod_name, mtime, names in registry:
+            m = _load_module(mod_name)
+            if _mtime(m) != mtime:
+                return False
+            loaded.append((m, names))
+        for m, names in loaded:
+            for name in names:
+                self.add_url(getattr(m, name))
+        self._registry.extend(registry)
+        return True
 
     def add_url(self, func):
         """
@@ -290,15 +705,27 @@ class WSGIApplication(object):
 
     # 添加一个Interceptor定义：
     def add_interceptor(self, func):
-        pass
+        self._check_not_running()
+        self._interceptors.append(func)
 
-    # 设置TemplateEngine：
-    @property 
-    def template_engine(self):
-        pass
-    @template_engine.setter
-    def template_engine(self, engine):
-        pass
+    def _match(self, request_method, path_info):
+        """
+        返回匹配的路由及URL参数
+        """
+        if request_method == 'GET':
+            static, dynamic = self._get_static, self._get_dynamic
+        elif request_method == 'POST':
+            static, dynamic = self._post_static, self._post_dynamic
+        else:
+            raise HttpError(405)
+        fn = static.get(path_info, None)
+        if fn:
+            return fn, ()
+        for fn in dynamic:
+            args = fn.match(path_info)
+            if args:
+                return fn, args
+        raise notfound()
 
     # 返回WSGI处理函数：
     def get_wsgi_application(self):
@@ -307,59 +734,124 @@ class WSGIApplication(object):
 
         _application = Dict(document_root=self._document_root)
 
+        metrics = self._metrics
+        limiter = self._limiter
+        api_prefix = self.api_prefix
+
         def fn_route():
-            request_method = ctx.request.request_method
-            path_info = ctx.request.path_info
-            if request_method == 'GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise HttpError('tmp')
-            if request_method == 'POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise HttpError('tmp')
-            raise HttpError('tmp')
+            request = ctx.request
+            t = time.time()
+            route, args = self._match(request.request_method, request.path_info)
+            request.route = route
+            request.add_timing('routing', time.time() - t)
+            if metrics:
+                metrics.route_matched(route)
+            token = limiter.acquire(route) if limiter else None
+            t = time.time()
+            ok = False
+            try:
+                r = route(*args)
+                ok = True
+                if token and _is_stream(r):
+                    # 流式输出结束时才释放，失败时状态码已被改为500
+                    def _release(token=token, response=ctx.response):
+                        limiter.release(token, response.status_code != 500, route)
+                    request._on_close.append(_release)
+                    token = None
+                return r
+            except HttpError:
+                ok = True
+                raise
+            finally:
+                request.add_timing('handler', time.time() - t)
+                if token:
+                    limiter.release(token, ok, route)
 
         fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
 
         def wsgi(env, start_response):
             ctx.application = _application
-            ctx.request = Request(env)
+            request = ctx.request = Request(env)
             response = ctx.response = Response()
+            start = time.time()
+            if metrics:
+                metrics.request_started(request)
+            token = None
+            stream = None
+
+            def _finish():
+                try:
+                    for fn in request._on_close:
+                        fn()
+                    if token:
+                        code = response.status_code
+                        limiter.release(token, None if code == 503 else code != 500, request.route)
+                    if metrics:
+                        metrics.request_finished(request, response.status_code, time.time() - start)
+                finally:
+                    del ctx.application
+                    del ctx.request
+                    del ctx.response
+
             try:
+                if limiter:
+                    token = limiter.acquire()
                 r = fn_exec()
                 if isinstance(r, Template):
+                    t = time.time()
                     r = self._template_engine(r.template_name, r.model)
+                    request.add_timing('template', time.time() - t)
                 if isinstance(r, unicode):
                     r = r.encode('utf-8')
+                if isinstance(r, str):
+                    r = [r]
                 if r is None:
                     r = []
                 start_response(response.status, response.headers)
+                if _is_stream(r):
+                    stream = _ClosingIterator(r, _application, request, response, _finish)
+                    return stream
                 return r
+            except HttpError, e:
+                response.status = e.status
+                if getattr(request.route, '__api__', False) or (api_prefix and request.path_info.startswith(api_prefix)):
+                    start_response(e.status, e.headers + [('Content-Type', 'application/json; charset=utf-8')])
+                    return [_http_error_json(e)]
+                start_response(e.status, e.headers + [('Content-Type', 'text/html; charset=utf-8')])
+                return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
-                pass
+                logging.exception('Error when handling %s %s' % (request.request_method, request.path_info))
+                response.status = 500
+                start_response(response.status, [('Content-Type', 'text/html; charset=utf-8')])
+                return ['<html><body><h1>500 Internal Server Error</h1></body></html>']
             finally:
-                del ctx.application
-                del ctx.request
-                del ctx.response
+                # 流式输出时由_ClosingIterator.close()结束请求
+                if stream is None:
+                    _finish()
         
         return wsgi
 
-    def run(self, port=9000, host='127.0.0.1'):
+    def run(self, port=9000, host='127.0.0.1', workers=0, **kw):
         """
-        开发模式下直接启动服务器
+        workers为0时启动单进程的开发服务器，worker_class为gevent时使用gevent.pywsgi，否则是单线程的wsgiref
+        否则启动prefork服务器，其余参数见transwarp.server.PreforkServer
         """
+        if workers:
+            from transwarp.server import PreforkServer
+            PreforkServer(self.get_wsgi_application(), host, port, workers=workers, **kw).run()
+            return
+        worker_class = kw.get('worker_class', 'sync')
+        if worker_class not in ('sync', 'gevent'):
+            raise ValueError('Invalid worker class: %s' % worker_class)
+        if worker_class == 'gevent':
+            from gevent import monkey
+            from gevent.pool import Pool
+            from gevent.pywsgi import WSGIServer as GeventWSGIServer
+            if not monkey.is_module_patched('thread'):
+                raise RuntimeError('gevent worker requires gevent.monkey.patch_all() before importing transwarp.')
+            GeventWSGIServer((host, port), self.get_wsgi_application(), spawn=Pool(kw.get('connections', 1000))).serve_forever()
+            return
         from wsgiref.simple_server import make_server
         server = make_server(host, port, self.get_wsgi_application())
-        server.server_forever()
+        server.serve_forever()
     
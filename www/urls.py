@@ -1,10 +1,88 @@
 # urls.py
+# -*- encoding: utf-8 -*-
 
-from transwarp.web import get, view
+import os
+
+from transwarp import db
+from transwarp.web import get, view, ctx, notfound, api, APIValueError, APIResourceNotFoundError
+from transwarp.session import SessionManager
+from transwarp.search import SearchIndex
+from transwarp.jobs import job
 from models import User, Blog, Comment
+from render import RenderCache
+from tasks import executor
+from config import configs
+
+# 签名Cookie的session，拦截器把当前用户绑定到ctx.request.user
+session = SessionManager(configs.session.secret, User)
+user_interceptor = session.interceptor('/')
+
+# Blog的全文索引，由wsgiapp加载，随ORM写入增量更新
+blog_index = SearchIndex(Blog, ('name', 'summary', 'content'), weights=dict(name=3, summary=2))
+
+@job('save_blog_index')
+def save_blog_index():
+    # 由wsgiapp定期执行，多个worker时每个周期只有一个保存
+    blog_index.save()
+
+# Blog内容的渲染缓存，Blog写入后在后台预先渲染
+render_cache = RenderCache(configs.render.cache_dir and os.path.join(os.path.dirname(os.path.abspath(__file__)), configs.render.cache_dir), defer=executor.defer)
 
 @view('test_users.html')
 @get('/')
 def test_users():
     users = User.find_all()
-    return dict(users=users)
\ No newline at end of file
+    return dict(users=users)
+
+@view('search.html')
+@get('/search')
+def search():
+    q = ctx.request.get('q', u'')
+    hits = blog_index.search(q, limit=20)
+    blogs = []
+    if hits:
+        keys = [k for k, score in hits]
+        d = dict((b.id, b) for b in Blog.find_by('where id in (%s)' % ','.join(['?'] * len(keys)), *keys))
+        blogs = [d[k] for k in keys if k in d]
+    return dict(q=q, blogs=blogs)
+
+@view('blog.html')
+@get('/blog/:blog_id')
+def blog(blog_id):
+    blog = Blog.get(blog_id)
+    if blog is None:
+        raise notfound()
+    return dict(blog=blog, rendered=render_cache.get(blog))
+
+def _get_limit(default=20, maximum=1000):
+    limit = ctx.request.get('limit', str(default))
+    if not limit.isdigit() or not 0 < int(limit) <= maximum:
+        raise APIValueError('limit', 'limit must be between 1 and %d.' % maximum)
+    return int(limit)
+
+@api
+@get('/api/blogs')
+def api_blogs():
+    # 列表不需要content，直接从cursor分块输出
+    return db.select_iter('select id, user_id, user_name, user_image, name, summary, created_at from blogs order by created_at desc limit ?', _get_limit())
+
+@api
+@get('/api/blogs/:blog_id')
+def api_blog(blog_id):
+    blog = Blog.get(blog_id)
+    if blog is None:
+        raise APIResourceNotFoundError('blog_id')
+    return blog
+
+@api
+@get('/api/blogs/:blog_id/comments')
+def api_comments(blog_id):
+    return Comment.find_by('where blog_id=? order by created_at desc limit ?', blog_id, _get_limit(100))
+
+@api
+@get('/api/users/:user_id')
+def api_user(user_id):
+    user = User.get(user_id)
+    if user is None:
+        raise APIResourceNotFoundError('user_id')
+    return user
\ No newline at end of file
@@ -1,28 +1,109 @@
 # wsgiapp.py
 # -*- encoding: utf-8 -*-
 
-import logging; logging.basicConfig(level=logging.INFO)
 import os
+# gevent worker需要在导入其他模块之前打补丁，使threading.local成为greenlet local
+WORKER_CLASS = os.environ.get('WORKER_CLASS', 'sync')
+if WORKER_CLASS == 'gevent':
+    from gevent import monkey; monkey.patch_all()
+
+import logging; logging.basicConfig(level=logging.INFO)
+
+# STARTUP_PROFILE=1时记录各模块的导入耗时和各初始化阶段的耗时
+from transwarp.startup import StartupProfiler
+startup_profiler = StartupProfiler()
+if os.environ.get('STARTUP_PROFILE'):
+    startup_profiler.install()
 
 from transwarp import db
 from transwarp.web import WSGIApplication, jinja2TemplateEngine
+from transwarp.metrics import Metrics, SamplingProfiler
+from transwarp.limiter import AdmissionController
+from transwarp.schema import QueryRecorder
+from transwarp.bus import InvalidationBus
 
 from config import configs
 
-# 初始化数据库
-db.create_engine(**configs.db)
+# 初始化数据库，驱动在第一次连接时才导入
+with startup_profiler.phase('db'):
+    db.create_engine(**configs.db)
+
+# 配置了schema.queries时记录select语句，用dbtool.py advise分析需要的索引
+if configs.schema.queries:
+    db.add_sql_listener(QueryRecorder(os.path.join(os.path.dirname(os.path.abspath(__file__)), configs.schema.queries)))
 
 # 创建一个WSGIApplication
 wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
 
-# 初始化jinja2模板引擎
+# 初始化jinja2模板引擎，Environment在第一次渲染时才创建
 template_engine = jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
 wsgi.template_engine = template_engine
 
+# 请求监控，配置了profile_dir时开启采样profiler
+# 多进程时各worker通过share_dir交换指标，任意一个worker都输出全部worker的指标
+profiler = None
+if configs.metrics.profile_dir:
+    profiler = SamplingProfiler(configs.metrics.profile_dir, every=configs.metrics.profile_every, threshold=configs.metrics.profile_threshold)
+wsgi.metrics = Metrics(configs.metrics.path, profiler=profiler, share_dir=configs.server.workers and configs.metrics.share_dir or None)
+
+# 并发限制，过载时快速返回503
+# sync worker同时处理的请求不超过server.threads个，limit默认就是threads，adaptive时在此之下调整；
+# 超过threads的连接在worker的线程池队列（threads*4）中等待，队列满时由accept循环直接返回503，
+# 所以sync worker中limiter的等待队列只在adaptive调低上限或有路由级上限时才有请求。
+# gevent worker没有线程池，每个连接一个协程，limit默认为threads*8，超过后由limiter排队和返回503
+limiter_configs = dict(configs.limiter)
+if limiter_configs['limit'] is None:
+    limiter_configs['limit'] = configs.server.threads * (8 if WORKER_CLASS == 'gevent' else 1)
+wsgi.limiter = AdmissionController(exclude=(configs.metrics.path, ), **limiter_configs)
+wsgi.metrics.add_collector(wsgi.limiter.metrics)
+
+# 后台任务
+from tasks import executor
+wsgi.metrics.add_collector(executor.metrics)
+
 # 加载带有@get/@post的URL处理函数
-import urls
-wsgi.add_module(urls)
+# 路由保存在startup.routes文件中，模块没有修改时直接加载，不用扫描模块
+with startup_profiler.phase('routes'):
+    import urls
+    wsgi.add_interceptor(urls.user_interceptor)
+    routes_file = configs.startup.routes and os.path.join(os.path.dirname(os.path.abspath(__file__)), configs.startup.routes)
+    modules = ('urls', 'feeds')
+    if not (routes_file and wsgi.load_routes(routes_file, *modules)):
+        for m in modules:
+            wsgi.add_module(m)
+        if routes_file:
+            wsgi.save_routes(routes_file)
+
+# 加载全文索引，索引文件不存在或已过期时从数据库建立，之后定期保存
+with startup_profiler.phase('search'):
+    urls.blog_index.open(os.path.join(os.path.dirname(os.path.abspath(__file__)), configs.search.path))
+    if configs.search.save_interval:
+        executor.schedule('save_blog_index', configs.search.save_interval)
+
+# 多进程时，写入数据库后通过Unix域socket通知其他worker清除缓存
+bus = None
+if configs.server.workers:
+    import feeds
+    bus = InvalidationBus(configs.bus.path, interval=configs.bus.interval, ignore=('jobs', ))
+    db.add_sql_listener(bus.on_sql)
+    bus.subscribe(urls.session.on_change)
+    bus.subscribe(feeds.on_change)
+    bus.subscribe(urls.blog_index.on_change, local=False)
+    wsgi.metrics.add_collector(bus.metrics)
+
+startup_profiler.uninstall()
+if os.environ.get('STARTUP_PROFILE'):
+    logging.info(startup_profiler.report())
 
-# 在9000端口上启动本地测试服务器
+# 在9000端口上启动服务器，server.workers为0时是本地测试服务器
+# 后台任务和采样profiler的线程不能跨fork，prefork时在每个worker中启动
 if __name__=='__main__':
-    wsgi.run(9000)
\ No newline at end of file
+    threads = [executor.start]
+    if profiler:
+        threads.append(profiler.start_sampler)
+    if configs.server.workers:
+        wsgi.run(9000, worker_class=WORKER_CLASS, after_fork=[db.reinit_after_fork, bus.start] + threads, **configs.server)
+    else:
+        for fn in threads:
+            fn()
+        wsgi.run(9000, worker_class=WORKER_CLASS, **configs.server)
\ No newline at end of file